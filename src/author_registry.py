@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+import asyncio
+import logging
+import time
+
+from message_types import *
+
+log = logging.getLogger('main')
+
+
+def _same_picture(old: Optional[IPicture], new: Optional[IPicture]) -> bool:
+    if isinstance(old, UrlPicture) and isinstance(new, UrlPicture):
+        return old.url == new.url
+    return old is None and new is None
+
+
+@dataclass
+class AuthorRegistry:
+    '''
+    Авторы по ключу (platform, id). Автор, которого не обновляли дольше refresh_ttl,
+    обновляется в фоне, а пока отдаётся старая версия
+    '''
+    refresh_ttl: Optional[float] = 60 * 60 * 6
+    authors: dict[tuple[Platform, int], Author] = field(default_factory=dict, repr=False)
+    fetched_at: dict[tuple[Platform, int], float] = field(default_factory=dict, repr=False)
+    refreshing: dict[tuple[Platform, int], asyncio.Task] = field(default_factory=dict, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.authors)
+
+    def get(self, platform: Platform, id: int) -> Optional[Author]:
+        return self.authors.get((platform, id))
+
+    def add(self, author: Author):
+        key = (author.platform, author.id)
+        self.authors[key] = author
+        self.fetched_at[key] = time.monotonic()
+
+    def is_stale(self, author: Author) -> bool:
+        if self.refresh_ttl is None:
+            return False
+        fetched_at = self.fetched_at.get((author.platform, author.id))
+        return fetched_at is None or time.monotonic() - fetched_at > self.refresh_ttl
+
+    def refresh(self, author: Author, fetch: Callable[[], Awaitable[Author]]):
+        '''
+        Запускает фоновое обновление автора, если оно ещё не идёт
+        '''
+        key = (author.platform, author.id)
+        if key in self.refreshing:
+            return
+        self.refreshing[key] = asyncio.create_task(self._refresh(key, author, fetch))
+
+    async def _refresh(self, key: tuple[Platform, int], author: Author, fetch: Callable[[], Awaitable[Author]]):
+        try:
+            fresh = await fetch()
+        except Exception as e:
+            log.warning(f'Не получилось обновить автора {author.name}: {e}')
+            # попробуем снова не раньше чем через refresh_ttl
+            self.fetched_at[key] = time.monotonic()
+            return
+        finally:
+            self.refreshing.pop(key, None)
+        # обновляем на месте, потому что на этого автора ссылаются уже сохранённые сообщения
+        author.name = fresh.name
+        author.username = fresh.username
+        if not _same_picture(author.pfp, fresh.pfp):
+            author.pfp = fresh.pfp
+            author.pfp_url = fresh.pfp_url
+        self.fetched_at[key] = time.monotonic()
+        log.debug(f'Обновили автора {author.name}')
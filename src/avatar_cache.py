@@ -0,0 +1,95 @@
+from dataclasses import dataclass, field
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+
+from message_types import *
+
+log = logging.getLogger('main')
+
+
+@dataclass
+class AvatarCache:
+    '''
+    Ссылки на выложенные аватарки по sha256 их содержимого. Одинаковая картинка выкладывается
+    один раз, даже если она у разных авторов или бот перезапускался. Если задан path, кэш хранится в json
+    '''
+    path: Optional[str] = None
+    # sha256 -> ссылка на выложенную картинку
+    urls: dict[str, str] = field(default_factory=dict, repr=False)
+    uploading: dict[str, asyncio.Task] = field(default_factory=dict, repr=False)
+
+    hits: int = 0
+    misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.urls.update(json.load(f))
+        except (OSError, ValueError) as e:
+            log.warning(f'Не получилось прочитать кэш аватарок {self.path}: {e}')
+            return
+        log.info(f'Загрузили {len(self.urls)} ссылок на аватарки из {self.path}')
+
+    def save(self):
+        if not self.path:
+            return
+        # пишем во временный файл и подменяем, чтобы не оставить обрезанный json при падении
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.urls, f)
+        os.replace(temp_path, self.path)
+
+    async def get_url(self, picture: IPicture, uploader: 'IUploader') -> Optional[str]:
+        data = await picture.fetch_data()
+        png = None
+        if data is None:
+            png = await picture.encode('png')
+            if png is None:
+                return None
+            data = png
+        digest = hashlib.sha256(data).hexdigest()
+
+        if url := self.urls.get(digest):
+            self.hits += 1
+            return url
+        self.misses += 1
+        # одну и ту же аватарку могут запросить сразу несколько отправок
+        task = self.uploading.get(digest)
+        if task is None:
+            task = asyncio.create_task(self._upload(digest, picture, png, uploader))
+            self.uploading[digest] = task
+        return await asyncio.shield(task)
+
+    async def _upload(self, digest: str, picture: IPicture, png: Optional[bytes], uploader: 'IUploader') -> Optional[str]:
+        try:
+            png = png or await picture.encode('png')
+            url = await uploader.upload(png) if png is not None else None
+        finally:
+            self.uploading.pop(digest, None)
+        if url is None:
+            return None
+        self.urls[digest] = url
+        try:
+            await asyncio.to_thread(self.save)
+        except OSError as e:
+            log.warning(f'Не получилось сохранить кэш аватарок {self.path}: {e}')
+        log.info(f'Выложили аватарку {digest[:12]}: {url}')
+        return url
+
+    def stats(self) -> dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            'avatars': len(self.urls),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+        }
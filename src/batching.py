@@ -0,0 +1,68 @@
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+import asyncio
+import logging
+
+log = logging.getLogger('main')
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+@dataclass
+class Batcher(Generic[K, V]):
+    '''
+    Собирает ключи, запрошенные в течение window секунд, и получает их все одним вызовом fetch.
+    fetch возвращает словарь ключ -> значение, ключи без значения получают KeyError
+    '''
+    fetch: Callable[[list[K]], Awaitable[dict[K, V]]]
+    window: float = 0.05
+    max_batch: int = 100
+    pending: dict[K, asyncio.Future] = field(default_factory=dict, init=False, repr=False)
+    flush_task: Optional[asyncio.Task] = field(default=None, init=False, repr=False)
+    # event loop держит задачи только слабыми ссылками, без этого пачку могло собрать сборщиком мусора
+    running: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
+
+    async def get(self, key: K) -> V:
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            if len(self.pending) >= self.max_batch:
+                self._flush()
+            elif self.flush_task is None:
+                self.flush_task = asyncio.create_task(self._flush_later())
+        # shield, чтобы отмена одного ожидающего не отменила результат для остальных
+        return await asyncio.shield(future)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        self._flush()
+
+    def _flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, dict()
+        task = asyncio.create_task(self._run(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: dict[K, asyncio.Future]):
+        try:
+            results = await self.fetch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if future.done():
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(KeyError(key))
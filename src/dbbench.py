@@ -0,0 +1,51 @@
+import logging
+import sys
+import time
+
+from worker_types import *
+
+logging.getLogger('main').setLevel(logging.WARNING)
+
+# Замер стоимости db_add_message в зависимости от количества уже сохранённых сообщений.
+# Запуск: python3 src/dbbench.py [максимальное количество сообщений]
+
+SAMPLE = 1000
+
+chat = Chat(Platform.Telegram, -1, prefix='tg')
+author = Author(Platform.Telegram, id=1, name='bench', username='bench', pfp=None)
+
+
+def make_message(i: int, reply_to: Optional[Message] = None) -> Message:
+    return Message(MessageID(chat, i), author=author, text=f'сообщение {i}', reply_to=reply_to)
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    coordinator = Coordinator(settings={'cache_max_messages': limit + SAMPLE})
+    stored = 0
+    checkpoint = 1000
+    print(f'{"сохранено":>10} {"новое, мкс":>10} {"дубликат, мкс":>14}')
+    while checkpoint <= limit:
+        while stored < checkpoint:
+            coordinator.db_add_message(make_message(stored))
+            stored += 1
+
+        # новые сообщения отвечают на уже сохранённые, так что заодно проверяется рекурсия по reply_to
+        new_messages = [make_message(limit + stored + i, reply_to=make_message(i)) for i in range(SAMPLE)]
+        start = time.perf_counter()
+        for message in new_messages:
+            coordinator.db_add_message(message)
+        insert_time = (time.perf_counter() - start) / SAMPLE
+
+        start = time.perf_counter()
+        for message in new_messages:
+            coordinator.db_add_message(message)
+        duplicate_time = (time.perf_counter() - start) / SAMPLE
+
+        print(f'{checkpoint:>10} {insert_time * 1e6:>10.2f} {duplicate_time * 1e6:>14.2f}')
+        stored += SAMPLE
+        checkpoint *= 10
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ import nextcord
 from nextcord.ext import commands
 
 EMBED_REPLY_MARK = '~'
+# код ошибки discord Unknown Webhook
+UNKNOWN_WEBHOOK = 10015
 
 @dataclass
 class DiscordBot(IBot):
@@ -17,6 +19,15 @@ class DiscordBot(IBot):
     settings: dict[str, object] = field(default_factory=dict)
     bot: commands.Bot = field(default=None, init=False)
     task: asyncio.Task = field(default=None, init=False)
+    # channel id -> вебхук, через который бот пишет в этот канал
+    webhooks: dict[int, nextcord.Webhook] = field(default_factory=dict, init=False, repr=False)
+    webhook_locks: dict[int, asyncio.Lock] = field(default_factory=dict, init=False, repr=False)
+
+    # глобальный лимит discord 50 запросов в секунду, в канал - около 5 сообщений за 5 секунд.
+    # по маршрутам nextcord ограничивает сам, очередь сглаживает всплески до него
+    DEFAULT_RATE_LIMIT = 50
+    DEFAULT_CHAT_RATE_LIMIT = 60
+    DEFAULT_CHAT_BURST = 5
 
     def _is_message_from_this_bot(self, native_message: nextcord.Message):
         if native_message.author.bot and native_message.author.discriminator == '0000':
@@ -26,7 +37,7 @@ class DiscordBot(IBot):
     def _message_preview_for_log(self, native_message: nextcord.Message):
         return f'{native_message.author.name}: {native_message.content[:20]}'
 
-    def _message_id_from_native(self, chat: Chat, native_message: nextcord.Message):
+    async def _message_id_from_native(self, chat: Chat, native_message: nextcord.Message):
         return MessageID(chat, native_message.id)
 
     def __post_init__(self):
@@ -43,33 +54,62 @@ class DiscordBot(IBot):
 
         @self.bot.event
         async def on_message(native_message: nextcord.Message):
+            self._remember_native_message(native_message)
             await self._handle_new_message(native_message)
         
         @self.bot.event
         async def on_message_edit(_before: nextcord.Message, after: nextcord.Message):
+            self._remember_native_message(after)
             await self._handle_edit_message(after)
         
         @self.bot.event
         async def on_message_delete(native_message: nextcord.Message):
             await self._handle_delete_message(native_message)
 
+    def _remember_native_message(self, native_message: nextcord.Message):
+        chat = self.get_current_chat_from_native_message(native_message)
+        if chat:
+            self.remember_native(chat, native_message.id, native_message)
+
+    async def _get_reference_message(self, native_message: nextcord.Message, chat: Chat) -> Optional[nextcord.Message]:
+        """
+        Достаёт сообщение, на которое отвечают: из самого события, из недавних сообщений чата и только потом запросом
+        """
+        reference = native_message.reference
+        if isinstance(reference.resolved, nextcord.Message):
+            return reference.resolved
+        if recent := self.get_recent_native(chat, reference.message_id):
+            return recent
+        log.debug(f'Запрашиваем сообщение {reference.message_id}, на которое ответили')
+        reference_message = await native_message.channel.fetch_message(reference.message_id)
+        self.remember_native(chat, reference_message.id, reference_message)
+        return reference_message
+
     def get_current_chat_from_native_message(self, message: nextcord.Message):
+        if message.guild is None:
+            return None
         return self.get_current_chat(Platform.Discord, message.guild.id, message.channel.id)
     
-    def get_author(self, user: nextcord.User):
-        author = self.coordinator.get_author(Platform.Discord, user.id)
-        if author: 
-            return author
+    def _author_id_from_native(self, user: nextcord.User) -> int:
+        return user.id
+
+    def _retry_after(self, exception: Exception) -> Optional[float]:
+        if isinstance(exception, nextcord.HTTPException) and exception.status == 429:
+            return float(exception.response.headers.get('Retry-After', 1))
+        return None
+
+    def _is_transient(self, exception: Exception) -> bool:
+        return isinstance(exception, nextcord.DiscordServerError) or super()._is_transient(exception)
+
+    async def _fetch_author(self, user: nextcord.User) -> Author:
         pfp = None
         if user.avatar:
             pfp = UrlPicture(f'pfp of {user.name}', user.avatar.url)
-        author = Author(Platform.Discord, id=user.id, 
-                        name=user.display_name or user.global_name or user.name, 
-                        username=user.name, pfp=pfp)
-        self.coordinator.add_author(author)
-        return author
+        return Author(Platform.Discord, id=user.id, 
+                      name=user.display_name or user.global_name or user.name, 
+                      username=user.name, pfp=pfp)
 
-    async def create_message_from_native(self, native_message: nextcord.Message, chat: Chat, retrieve_from_db=True) -> Optional[Message]:
+    async def create_message_from_native(self, native_message: nextcord.Message, chat: Chat, retrieve_from_db=True, depth: int = 0) -> Optional[Message]:
         if native_message is None:
             return None
         if retrieve_from_db:
@@ -77,10 +117,13 @@ class DiscordBot(IBot):
             if message:
                 return message
         reply_to = None
-        if native_message.reference:
+        if native_message.reference and native_message.reference.message_id and self.can_resolve_reply(depth):
             try:
-                reference_message = await native_message.channel.fetch_message(native_message.reference.message_id)
-                reply_to = await self.create_message_from_native(reference_message, chat)
+                # уже пересланное сообщение есть в базе, нативное для него не нужно
+                reply_to = self.coordinator.db_get_message(MessageID(chat, native_message.reference.message_id))
+                if reply_to is None:
+                    reference_message = await self._get_reference_message(native_message, chat)
+                    reply_to = await self.create_message_from_native(reference_message, chat, depth=depth + 1)
             except Exception:
                 log.warning('Не получилось получить reference сообщение')
         
@@ -108,7 +151,7 @@ class DiscordBot(IBot):
             attachments.append(sticker)
         
         message = Message(MessageID(chat, native_message.id),
-                            author=self.get_author(native_message.author),
+                            author=await self.get_author(native_message.author),
                             text=native_message.content, reply_to=reply_to,
                             attachments=attachments)
         return message
@@ -123,20 +166,58 @@ class DiscordBot(IBot):
         return self.settings.get('embed', False)
 
     async def get_webhook(self, channel: nextcord.TextChannel, name: str = 'bridge-bot', webhook_avatar: bytes = None) -> nextcord.Webhook:
+        '''
+        Вебхук канала достаётся из discord один раз и дальше берётся из кэша, пока не пропадёт
+        '''
         if not isinstance(channel, nextcord.TextChannel):
             return None
+        if webhook := self.webhooks.get(channel.id):
+            return webhook
         
-        webhooks = await channel.webhooks()
-        webhook = None
-        for wh in webhooks:
-            if wh.name.startswith(name):
-                webhook = wh
-                break
+        # без блокировки одновременные отправки в новый канал создали бы по своему вебхуку
+        lock = self.webhook_locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            if webhook := self.webhooks.get(channel.id):
+                return webhook
+            webhooks = await channel.webhooks()
+            webhook = None
+            for wh in webhooks:
+                if wh.name.startswith(name):
+                    webhook = wh
+                    break
+            if webhook is None:
+                webhook = await channel.create_webhook(name=name + ' ' + str(time.time())[-5:], 
+                                       avatar=webhook_avatar, 
+                                       reason='Created for bridge bot to send webhooks')
+            self.webhooks[channel.id] = webhook
+            return webhook
+    
+    def invalidate_webhook(self, channel_id: int, webhook: Optional[nextcord.Webhook] = None):
+        '''
+        Убирает вебхук канала из кэша. Если передан webhook, убирает только его, чтобы не выкинуть уже заменённый
+        '''
+        cached = self.webhooks.get(channel_id)
+        if cached is not None and (webhook is None or cached.id == webhook.id):
+            del self.webhooks[channel_id]
+            log.info(f'Вебхук {cached.id} канала {channel_id} больше не существует, убрали из кэша')
+
+    async def send_webhook(self, channel: nextcord.TextChannel, files: list[nextcord.File], **kwargs) -> Optional[nextcord.WebhookMessage]:
+        '''
+        Отправляет сообщение через вебхук канала. Если вебхук удалили, достаёт новый и отправляет ещё раз
+        '''
+        webhook = await self.get_webhook(channel)
         if webhook is None:
-            webhook = await channel.create_webhook(name=name + ' ' + str(time.time())[-5:], 
-                                   avatar=webhook_avatar, 
-                                   reason='Created for bridge bot to send webhooks')
-        return webhook
+            return None
+        try:
+            return await webhook.send(files=files, wait=True, **kwargs)
+        except nextcord.NotFound as e:
+            if e.code != UNKNOWN_WEBHOOK:
+                raise
+            self.invalidate_webhook(channel.id, webhook)
+        webhook = await self.get_webhook(channel)
+        for file in files:
+            file.reset()
+        return await webhook.send(files=files, wait=True, **kwargs)
     
     def start(self):
         self.task = asyncio.create_task(self.bot.start(self.settings['token']))
@@ -165,17 +246,18 @@ class DiscordBot(IBot):
         default_text = f'{webhook_nick}: {text}'
         return self.FormattedMessage(nick, webhook_nick, text, default_text, footer)
     
-    def get_pfp_url(self, author: Author) -> Optional[str]:
+    async def get_pfp_url(self, author: Author) -> Optional[str]:
         if author.pfp_url:
             return author.pfp_url
         if author.pfp and isinstance(author.pfp, UrlPicture):
             return author.pfp.url
         if author.pfp:
             if uploader := self.settings.get('uploader', None):
-                buffer = io.BytesIO()
-                author.pfp.get_image().save(buffer, 'png')
-                buffer.seek(0)
-                url = uploader.upload(buffer)
+                try:
+                    url = await self.coordinator.avatars.get_url(author.pfp, uploader)
+                except Exception as e:
+                    log.warning(f'Не получилось выложить аватарку {author.name}: {e}')
+                    return None
                 author.pfp_url = url
                 return url
             else:
@@ -197,24 +279,29 @@ class DiscordBot(IBot):
         files = []
         for attachment in message.attachments:
             if isinstance(attachment, IPicture):
-                image = attachment.get_image()
-                buffer = io.BytesIO()
-                image.save(buffer, format='webp')
-                buffer.seek(0)
+                image_data = await attachment.encode('webp')
+                if image_data is None:
+                    log.warning(f'Картинку {attachment.name} не получилось достать, пропускаем')
+                    continue
+                buffer = io.BytesIO(image_data)
                 file = nextcord.File(fp=buffer, filename=(attachment.name or 'image') + '.webp')
                 files.append(file)
             elif isinstance(attachment, Sticker):
-                image = attachment.picture.get_image()
-                buffer = io.BytesIO()
-                image.resize((160, 160)).save(buffer, format='webp')
-                buffer.seek(0)
+                image_data = await attachment.picture.encode('webp', STICKER_SIZE)
+                if image_data is None:
+                    log.warning(f'Стикер {attachment.name} не получилось достать, пропускаем')
+                    continue
+                buffer = io.BytesIO(image_data)
                 file = nextcord.File(fp=buffer, filename=(attachment.name or 'image') + '.webp')
                 files.append(file)
             elif isinstance(attachment, IFile):
-                file_data = attachment.get_file()
-                buffer = io.BytesIO(file_data)
-                buffer.seek(0)
-                file = nextcord.File(fp=buffer, filename=(attachment.name or 'file.dat'))
+                buffer = await attachment.fetch_buffer()
+                if buffer is None:
+                    log.warning(f'Файл {attachment.name} не скачался, отправляем вместо него ссылку')
+                    link = missing_file_link(attachment)
+                    links += f'{link.name}: {link.url} '
+                    continue
+                file = nextcord.File(fp=buffer_reader(buffer), filename=(attachment.name or 'file.dat'))
                 files.append(file)
             elif isinstance(attachment, UrlLink):
                 links += f'{attachment.name}: {attachment.url} '
@@ -233,19 +320,18 @@ class DiscordBot(IBot):
                 return
             
         if self.is_webhook_mode():
-            webhook = await self.get_webhook(channel)
-            if webhook is None:
+            if not isinstance(channel, nextcord.TextChannel):
                 log.error('Не получилось достать вебхук, фолбечим на обычное редактирование')
             else:
                 uploader = self.settings.get('uploader', None)
-                url = self.get_pfp_url(message.author)
+                url = await self.get_pfp_url(message.author)
                 if url is None and uploader is None:
                     log.warn('uploader для дискорд бота с вебхуком не установлен, без него некоторые аватарки не получится отобразить')
                 if self.is_embed_mode() and message.reply_to:
                     formatted_reply = self.format_message(message.reply_to)
 
                     embed = nextcord.Embed(type='rich', color=0x000000)
-                    embed.set_author(name= EMBED_REPLY_MARK + 'В ответ на ' +formatted_reply.nick, icon_url=self.get_pfp_url(message.reply_to.author))
+                    embed.set_author(name= EMBED_REPLY_MARK + 'В ответ на ' +formatted_reply.nick, icon_url=await self.get_pfp_url(message.reply_to.author))
                     embed.description = formatted_reply.text
                     embed.set_footer(text=formatted_reply.footer)
 
@@ -255,22 +341,23 @@ class DiscordBot(IBot):
                     else:
                         mention = ''
                     
-                    sent_message: nextcord.WebhookMessage = await webhook.send(content=formatted.text + mention, 
-                                                                               username=formatted.webhook_nick,
-                                                                               avatar_url=url, embed=embed, 
-                                                                               files=files, wait=True)
-                    message.set_data(chat, 'webhook', sent_message)
+                    sent_message: nextcord.WebhookMessage = await self.send_webhook(channel, files,
+                                                                                    content=formatted.text + mention, 
+                                                                                    username=formatted.webhook_nick,
+                                                                                    avatar_url=url, embed=embed)
+                    message.set_data(chat, 'webhook', sent_message.webhook_id)
                     return MessageID(chat, sent_message.id)
                 else:
-                    sent_message: nextcord.WebhookMessage = await webhook.send(content=formatted.text, username=formatted.webhook_nick,
-                                                                            avatar_url=url, files=files, wait=True)
-                    message.set_data(chat, 'webhook', sent_message)
+                    sent_message: nextcord.WebhookMessage = await self.send_webhook(channel, files,
+                                                                                    content=formatted.text, username=formatted.webhook_nick,
+                                                                                    avatar_url=url)
+                    message.set_data(chat, 'webhook', sent_message.webhook_id)
                     return MessageID(chat, sent_message.id)
         
         embed = None
         if self.is_embed_mode():
             embed = nextcord.Embed(type='rich', color=0x000000)
-            embed.set_author(name=formatted.nick, icon_url=self.get_pfp_url(message.author))
+            embed.set_author(name=formatted.nick, icon_url=await self.get_pfp_url(message.author))
             embed.description = formatted.text
             embed.set_footer(text=formatted.footer)
 
@@ -295,9 +382,17 @@ class DiscordBot(IBot):
         formatted = self.format_message(new_message, links)
 
         if self.is_webhook_mode():
-            webhook_message: nextcord.WebhookMessage = old_message.get_data(message_id.chat, 'webhook', dict())
-            if webhook_message:
-                await webhook_message.edit(content=formatted.text)
+            webhook_id: Optional[int] = old_message.get_data(message_id.chat, 'webhook')
+            if webhook_id:
+                webhook = await self.get_webhook(channel)
+                if webhook is None or webhook.id != webhook_id:
+                    webhook = await self.bot.fetch_webhook(webhook_id)
+                try:
+                    await webhook.edit_message(message_id.id, content=formatted.text)
+                except nextcord.NotFound as e:
+                    if e.code == UNKNOWN_WEBHOOK:
+                        self.invalidate_webhook(channel.id, webhook)
+                    raise
                 return
             else:
                 log.error('Не получилось достать webhook сообщение,')
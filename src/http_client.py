@@ -0,0 +1,49 @@
+from typing import Optional
+import logging
+
+import aiohttp
+
+log = logging.getLogger('main')
+
+CONNECTION_LIMIT = 32
+KEEPALIVE_TIMEOUT = 30
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+CHUNK_SIZE = 64 * 1024
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    '''
+    Общая на всё приложение сессия aiohttp с пулом соединений и keep-alive
+    '''
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+    return _session
+
+
+async def download(url: str, max_size: int) -> bytes:
+    '''
+    Скачивает файл по частям и бросает ValueError, если он больше max_size
+    '''
+    async with get_session().get(url) as response:
+        response.raise_for_status()
+        if response.content_length is not None and response.content_length > max_size:
+            raise ValueError(f'Файл {url} весит {response.content_length} байт, больше {max_size}')
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            data += chunk
+            if len(data) > max_size:
+                raise ValueError(f'Файл {url} больше {max_size} байт')
+        return bytes(data)
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
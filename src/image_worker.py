@@ -0,0 +1,108 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+import asyncio
+import io
+import logging
+import time
+
+from PIL import Image
+
+log = logging.getLogger('main')
+
+DEFAULT_EXECUTOR = 'process'
+DEFAULT_WORKERS = 2
+
+_executor: Optional[Executor] = None
+
+
+@dataclass
+class EncodeTiming:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+# format -> сколько раз и как долго кодировали картинки в этот формат
+encode_timings: dict[str, EncodeTiming] = dict()
+
+
+def encode_image(image: Image.Image, format: str, size: Optional[tuple[int, int]] = None, mode: Optional[str] = None) -> bytes:
+    if mode and image.mode != mode:
+        image = image.convert(mode)
+    if size:
+        image = image.resize(size)
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def encode_bytes(data: bytes, format: str, size: Optional[tuple[int, int]] = None, mode: Optional[str] = None) -> bytes:
+    '''
+    Выполняется в пуле: байты картинки на вход, байты в нужном формате на выход
+    '''
+    with Image.open(io.BytesIO(data)) as image:
+        return encode_image(image, format, size, mode)
+
+
+def configure(kind: str = DEFAULT_EXECUTOR, workers: int = DEFAULT_WORKERS):
+    '''
+    Создаёт пул для обработки картинок: kind - process или thread
+    '''
+    global _executor
+    shutdown()
+    match kind:
+        case 'process':
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        case 'thread':
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+        case _:
+            raise ValueError(f'Неизвестный тип пула для картинок {kind}, нужен process или thread')
+    log.info(f'Картинки обрабатываются в пуле {kind} на {workers} воркеров')
+
+
+def get_executor() -> Executor:
+    if _executor is None:
+        configure()
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+
+
+def _record(format: str, started: float):
+    seconds = time.perf_counter() - started
+    encode_timings.setdefault(format, EncodeTiming()).add(seconds)
+    log.debug(f'Закодировали картинку в {format} за {seconds * 1000:.1f} мс')
+
+
+async def encode(data: bytes, format: str, size: Optional[tuple[int, int]] = None, mode: Optional[str] = None) -> bytes:
+    started = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(get_executor(), encode_bytes, data, format, size, mode)
+    _record(format, started)
+    return result
+
+
+async def encode_decoded(image: Image.Image, format: str, size: Optional[tuple[int, int]] = None, mode: Optional[str] = None) -> bytes:
+    '''
+    Для картинок, у которых нет исходных байтов: объект PIL нельзя отдать в другой процесс, поэтому кодируем в потоке
+    '''
+    started = time.perf_counter()
+    result = await asyncio.to_thread(encode_image, image, format, size, mode)
+    _record(format, started)
+    return result
+
+
+def encode_stats() -> dict[str, dict[str, float]]:
+    return {format: {'count': timing.count, 'total': timing.total, 'max': timing.max,
+                     'average': timing.total / timing.count if timing.count else 0.0}
+            for format, timing in encode_timings.items()}
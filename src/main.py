@@ -35,6 +35,8 @@ def tryexcept_get(function, _default=None, *args, **kwargs):
         pass
     return _default
 
+import http_client
+import image_worker
 from worker_types import *
 from discord import *
 from telegram import *
@@ -52,10 +54,13 @@ async def main():
     with open('config.yaml', 'r', encoding='utf-8') as f:
         data: dict = yamlload(f, Loader=YamlLoader)
         
+    coordinator_key = list(data.keys())[0]
+
     global coordinator
-    coordinator = Coordinator()
+    coordinator = Coordinator(settings=data[coordinator_key].get('settings') or dict())
+    image_worker.configure(coordinator.settings.get('image_executor', image_worker.DEFAULT_EXECUTOR),
+                           coordinator.settings.get('image_workers', image_worker.DEFAULT_WORKERS))
     
-    coordinator_key = list(data.keys())[0]
     bots = data[coordinator_key]['bots']
     bridges = data[coordinator_key]['bridges']
     chats = data[coordinator_key]['chats']
@@ -106,7 +111,11 @@ async def main():
             coordinator.add_chat_to_bridge(bridge, chat)
         coordinator.link_bot_chat(bot, chat)
 
+    if database := coordinator.settings.get('database', None):
+        coordinator._load(database)
+
     coordinator.start_all_bots()
+    await coordinator.replay_dead_letters()
 
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()
@@ -119,5 +128,7 @@ if __name__ == '__main__':
         print('finally начало...')
         if coordinator is not None:
             coordinator.stop_all_bots()
+        loop.run_until_complete(http_client.close_session())
+        image_worker.shutdown()
         loop.stop()
         loop.close()
\ No newline at end of file
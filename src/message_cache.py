@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+import logging
+import time
+
+from message_types import *
+
+log = logging.getLogger('main')
+
+
+def message_attachments_size(message: Message) -> int:
+    return sum(attachment.cached_size() for attachment in message.attachments)
+
+
+@dataclass
+class MessageCache:
+    '''
+    Ограниченный кэш сообщений в памяти. Когда сообщений, их вложений или времени
+    без обращений становится слишком много, самые давно использованные сообщения
+    выкидываются, а их вложения выгружаются через IAttachment.uncache().
+    Сообщения, которые сейчас отправляются, закрепляются через pin и не выкидываются
+    '''
+    max_entries: int = 10000
+    max_age: Optional[float] = 60 * 60 * 24
+    max_attachment_bytes: int = 256 * 1024 * 1024
+
+    # ключ - original_id, порядок - от давно использованных к недавно использованным
+    messages: OrderedDict[MessageID, Message] = field(default_factory=OrderedDict, repr=False)
+    m_id_to_original: dict[MessageID, MessageID] = field(default_factory=dict, repr=False)
+    touched_at: dict[MessageID, float] = field(default_factory=dict, repr=False)
+    sizes: dict[MessageID, int] = field(default_factory=dict, repr=False)
+    # original_id -> сколько отправок сейчас используют сообщение
+    pinned: dict[MessageID, int] = field(default_factory=dict, repr=False)
+    attachment_bytes: int = 0
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __contains__(self, message: Message) -> bool:
+        return message.original_id in self.messages
+
+    def _touch(self, original_id: MessageID):
+        self.messages.move_to_end(original_id)
+        self.touched_at[original_id] = time.monotonic()
+
+    def add(self, message: Message):
+        original_id = message.original_id
+        if original_id in self.messages:
+            self._touch(original_id)
+            return
+        self.messages[original_id] = message
+        self.touched_at[original_id] = time.monotonic()
+        for m_id in [original_id] + message.relay_ids:
+            if m_id not in self.m_id_to_original:
+                self.m_id_to_original[m_id] = original_id
+        self.sizes[original_id] = 0
+        self.update_size(message)
+
+    def add_id(self, message_id: MessageID, message: Message):
+        if message.original_id not in self.messages:
+            self.add(message)
+        self.m_id_to_original[message_id] = message.original_id
+
+    def update_size(self, message: Message):
+        '''
+        Пересчитывает размер вложений сообщения, например после того как картинки скачались при отправке
+        '''
+        original_id = message.original_id
+        if original_id not in self.sizes:
+            return
+        size = message_attachments_size(message)
+        self.attachment_bytes += size - self.sizes[original_id]
+        self.sizes[original_id] = size
+        self.evict(keep=original_id)
+
+    def pin(self, message: Message):
+        '''
+        Не даёт выкинуть сообщение и выгрузить его вложения, пока оно отправляется
+        '''
+        self.pinned[message.original_id] = self.pinned.get(message.original_id, 0) + 1
+
+    def unpin(self, message: Message):
+        original_id = message.original_id
+        count = self.pinned.get(original_id, 0) - 1
+        if count > 0:
+            self.pinned[original_id] = count
+            return
+        self.pinned.pop(original_id, None)
+        # пока сообщение было закреплено, лимиты могли превыситься
+        self.evict()
+
+    def get(self, message_id: MessageID) -> Optional[Message]:
+        original_id = self.m_id_to_original.get(message_id)
+        if original_id is None:
+            self.misses += 1
+            return None
+        if original_id not in self.pinned and self._is_expired(original_id, time.monotonic()):
+            self._remove(original_id)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(original_id)
+        return self.messages[original_id]
+
+    def _is_expired(self, original_id: MessageID, now: float) -> bool:
+        return self.max_age is not None and now - self.touched_at[original_id] > self.max_age
+
+    def evict(self, keep: Optional[MessageID] = None):
+        now = time.monotonic()
+        # сначала выбираем, что выкинуть, потом выкидываем, чтобы не менять messages во время обхода
+        entries = len(self.messages)
+        attachment_bytes = self.attachment_bytes
+        evicted = []
+        for original_id in self.messages:
+            # только что добавленное и отправляемые сообщения не выкидываем
+            if original_id == keep or original_id in self.pinned:
+                continue
+            over_limit = entries > self.max_entries or attachment_bytes > self.max_attachment_bytes
+            if not over_limit and not self._is_expired(original_id, now):
+                break
+            evicted.append(original_id)
+            entries -= 1
+            attachment_bytes -= self.sizes.get(original_id, 0)
+        for original_id in evicted:
+            self._remove(original_id)
+
+    def _remove(self, original_id: MessageID):
+        message = self.messages.pop(original_id)
+        for m_id in [original_id] + message.relay_ids:
+            if self.m_id_to_original.get(m_id) == original_id:
+                del self.m_id_to_original[m_id]
+        self.attachment_bytes -= self.sizes.pop(original_id, 0)
+        del self.touched_at[original_id]
+        for attachment in message.attachments:
+            attachment.uncache()
+        self.evictions += 1
+        log.debug(f'Выгрузили из кэша сообщение {original_id}')
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'messages': len(self.messages),
+            'attachment_bytes': self.attachment_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
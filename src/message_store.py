@@ -0,0 +1,351 @@
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from message_types import *
+
+log = logging.getLogger('main')
+
+MAX_LOAD_REPLY_DEPTH = 10
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    author_platform INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    author_name TEXT,
+    author_username TEXT,
+    author_pfp_url TEXT,
+    text TEXT NOT NULL DEFAULT '',
+    reply_to INTEGER REFERENCES messages(id),
+    attachments TEXT NOT NULL DEFAULT '[]',
+    data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS message_ids (
+    platform INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    server_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    message INTEGER NOT NULL REFERENCES messages(id),
+    is_original INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS message_ids_key ON message_ids(platform, chat_id, server_id, message_id);
+CREATE INDEX IF NOT EXISTS message_ids_message ON message_ids(message);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    operation TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    platform INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    server_id INTEGER NOT NULL,
+    message INTEGER NOT NULL REFERENCES messages(id),
+    relay_message_id INTEGER,
+    text TEXT,
+    error TEXT,
+    failed_at REAL NOT NULL
+);
+'''
+
+
+@dataclass
+class DeadLetter:
+    '''
+    Отправка, редактирование или удаление, которое не удалось даже после повторов
+    '''
+    operation: str
+    bot_id: str
+    chat: Chat
+    message: Message
+    # для edit и delete - какое сообщение в чате chat менять
+    relay_id: Optional[MessageID] = None
+    # для edit - новый текст
+    text: Optional[str] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class IMessageStore:
+    '''
+    Постоянное хранилище сообщений и их relay id, которое переживает перезапуск
+    '''
+
+    def add_message(self, message: Message):
+        ...
+
+    def get_message(self, message_id: MessageID) -> Optional[Message]:
+        ...
+
+    def add_relay_id(self, message_id: MessageID, message: Message):
+        ...
+
+    def update_text(self, message_id: MessageID, text: str):
+        ...
+
+    def add_dead_letter(self, letter: DeadLetter):
+        ...
+
+    def drop_dead_letters(self, operation: str, relay_id: MessageID):
+        '''
+        Убирает отложенные операции operation над сообщением relay_id, например устаревшие редактирования
+        '''
+        ...
+
+    def pop_dead_letters(self) -> list[DeadLetter]:
+        '''
+        Возвращает все неудавшиеся операции и убирает их из хранилища
+        '''
+        ...
+
+    def flush(self):
+        '''
+        Записывает на диск всё, что ещё не записано
+        '''
+        ...
+
+    def close(self):
+        ...
+
+
+def _chat_key(chat: Chat) -> tuple[int, int, int]:
+    # NULL в уникальном индексе не сравнивается, поэтому отсутствующий server_id хранится как 0
+    return (Platform(chat.platform).value, chat.id, chat.server_id or 0)
+
+
+def _dump_data(data: dict) -> str:
+    result = dict()
+    for key, by_chat in data.items():
+        result[key] = [[*_chat_key(chat), value] for chat, value in by_chat.items()]
+    return json.dumps(result)
+
+
+def _attachment_to_dict(attachment: IAttachment) -> Optional[dict]:
+    if isinstance(attachment, UrlLink):
+        return {'type': 'link', 'name': attachment.name, 'url': attachment.url}
+    if isinstance(attachment, UrlFile):
+        return {'type': 'file', 'name': attachment.name, 'url': attachment.url}
+    if isinstance(attachment, UrlPicture):
+        return {'type': 'picture', 'name': attachment.name, 'url': attachment.url}
+    if isinstance(attachment, Sticker) and isinstance(attachment.picture, UrlPicture):
+        return {'type': 'sticker', 'name': attachment.name, 'url': attachment.picture.url}
+    # остальные вложения живут только в памяти и после перезапуска не нужны
+    return None
+
+
+def is_stored_attachment(attachment: IAttachment) -> bool:
+    '''
+    Переживёт ли вложение перезапуск. Данные остальных есть только в памяти
+    '''
+    return _attachment_to_dict(attachment) is not None
+
+
+def _dump_attachments(attachments: list[IAttachment]) -> str:
+    result = [item for item in map(_attachment_to_dict, attachments) if item is not None]
+    return json.dumps(result)
+
+
+def _load_attachments(raw: str) -> list[IAttachment]:
+    result = []
+    for item in json.loads(raw):
+        match item['type']:
+            case 'link':
+                result.append(UrlLink(item['name'], item['url']))
+            case 'file':
+                result.append(UrlFile(item['name'], item['url']))
+            case 'picture':
+                result.append(UrlPicture(item['name'], item['url']))
+            case 'sticker':
+                result.append(Sticker(item['name'], UrlPicture(item['name'], item['url'])))
+    return result
+
+
+@dataclass
+class SqliteMessageStore(IMessageStore):
+    path: str
+    # чаты и авторы в базе хранятся ключами, эти функции возвращают настоящие объекты из конфига
+    chat_resolver: Callable[[Chat], Chat] = field(default=lambda chat: chat, repr=False)
+    author_resolver: Callable[[Platform, int], Optional[Author]] = field(default=lambda platform, id: None, repr=False)
+    batch_size: int = 100
+    commit_interval: float = 5.0
+    connection: sqlite3.Connection = field(default=None, init=False, repr=False)
+    pending: int = field(default=0, init=False)
+    last_commit: float = field(default=0.0, init=False)
+    # без таймера последние изменения ждали бы следующей записи, которой может долго не быть
+    flush_timer: Optional[asyncio.TimerHandle] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        self.last_commit = time.monotonic()
+        log.info(f'Открыли базу сообщений {self.path}')
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.batch_size or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.flush()
+        elif self.flush_timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # вне event loop таймер не поставить, запишется при следующей записи или close
+                return
+            self.flush_timer = loop.call_later(self.commit_interval, self.flush)
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.connection is None:
+            return
+        self.connection.commit()
+        if self.pending:
+            log.debug(f'Записали {self.pending} изменений в базу сообщений')
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
+
+    def _find_row_id(self, message_id: MessageID) -> Optional[int]:
+        row = self.connection.execute(
+            'SELECT message FROM message_ids WHERE platform = ? AND chat_id = ? AND server_id = ? AND message_id = ?',
+            (*_chat_key(message_id.chat), message_id.id)).fetchone()
+        return row[0] if row else None
+
+    def _insert_id(self, message_id: MessageID, row_id: int, is_original: bool):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO message_ids (platform, chat_id, server_id, message_id, message, is_original) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (*_chat_key(message_id.chat), message_id.id, row_id, int(is_original)))
+
+    def _add_message(self, message: Message) -> int:
+        row_id = self._find_row_id(message.original_id)
+        if row_id is not None:
+            return row_id
+
+        reply_row_id = None
+        if message.reply_to:
+            reply_row_id = self._add_message(message.reply_to)
+
+        author = message.author
+        pfp_url = author.pfp_url
+        if pfp_url is None and isinstance(author.pfp, UrlPicture):
+            pfp_url = author.pfp.url
+        cursor = self.connection.execute(
+            'INSERT INTO messages (author_platform, author_id, author_name, author_username, author_pfp_url, '
+            'text, reply_to, attachments, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (Platform(author.platform).value, author.id, author.name, author.username, pfp_url,
+             message.text or '', reply_row_id, _dump_attachments(message.attachments), _dump_data(message.data)))
+        row_id = cursor.lastrowid
+        self._insert_id(message.original_id, row_id, True)
+        for relay_id in message.relay_ids:
+            self._insert_id(relay_id, row_id, False)
+        self._written()
+        return row_id
+
+    def add_message(self, message: Message):
+        self._add_message(message)
+
+    def add_relay_id(self, message_id: MessageID, message: Message):
+        row_id = self._add_message(message)
+        self._insert_id(message_id, row_id, False)
+        # send_message кладёт в data вебхуки, ссылки и id ответов, их тоже надо сохранить
+        self.connection.execute('UPDATE messages SET data = ? WHERE id = ?', (_dump_data(message.data), row_id))
+        self._written()
+
+    def _chat_from_key(self, platform: int, chat_id: int, server_id: int) -> Chat:
+        return self.chat_resolver(Chat(Platform(platform), chat_id, server_id or None))
+
+    def _load_message(self, row_id: int, depth: int = 0) -> Optional[Message]:
+        row = self.connection.execute(
+            'SELECT author_platform, author_id, author_name, author_username, author_pfp_url, '
+            'text, reply_to, attachments, data FROM messages WHERE id = ?', (row_id,)).fetchone()
+        if row is None:
+            return None
+        author_platform, author_id, author_name, author_username, author_pfp_url, text, reply_row_id, attachments, data = row
+
+        author = self.author_resolver(Platform(author_platform), author_id)
+        if author is None:
+            author = Author(Platform(author_platform), id=author_id, name=author_name, username=author_username,
+                            pfp=UrlPicture(f'pfp of {author_name}', author_pfp_url) if author_pfp_url else None,
+                            pfp_url=author_pfp_url)
+
+        reply_to = None
+        if reply_row_id is not None and depth < MAX_LOAD_REPLY_DEPTH:
+            reply_to = self._load_message(reply_row_id, depth + 1)
+
+        original_id = None
+        relay_ids = []
+        for platform, chat_id, server_id, message_id, is_original in self.connection.execute(
+                'SELECT platform, chat_id, server_id, message_id, is_original FROM message_ids WHERE message = ? ORDER BY rowid',
+                (row_id,)):
+            m_id = MessageID(self._chat_from_key(platform, chat_id, server_id), message_id)
+            if is_original:
+                original_id = m_id
+            else:
+                relay_ids.append(m_id)
+
+        message = Message(original_id, author=author, text=text, reply_to=reply_to,
+                          relay_ids=relay_ids, attachments=_load_attachments(attachments))
+        for key, values in json.loads(data).items():
+            for platform, chat_id, server_id, value in values:
+                message.set_data(self._chat_from_key(platform, chat_id, server_id), key, value)
+        return message
+
+    def get_message(self, message_id: MessageID) -> Optional[Message]:
+        row_id = self._find_row_id(message_id)
+        if row_id is None:
+            return None
+        return self._load_message(row_id)
+
+    def update_text(self, message_id: MessageID, text: str):
+        row_id = self._find_row_id(message_id)
+        if row_id is None:
+            return
+        self.connection.execute('UPDATE messages SET text = ? WHERE id = ?', (text or '', row_id))
+        self._written()
+
+    def add_dead_letter(self, letter: DeadLetter):
+        row_id = self._add_message(letter.message)
+        self.connection.execute(
+            'INSERT INTO dead_letters (operation, bot_id, platform, chat_id, server_id, message, relay_message_id, '
+            'text, error, failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (letter.operation, letter.bot_id, *_chat_key(letter.chat), row_id,
+             letter.relay_id.id if letter.relay_id else None, letter.text, letter.error, time.time()))
+        # неудавшиеся операции пишем сразу, они не должны потеряться при падении
+        self.flush()
+
+    def drop_dead_letters(self, operation: str, relay_id: MessageID):
+        cursor = self.connection.execute(
+            'DELETE FROM dead_letters WHERE operation = ? AND platform = ? AND chat_id = ? AND server_id = ? '
+            'AND relay_message_id = ?', (operation, *_chat_key(relay_id.chat), relay_id.id))
+        if cursor.rowcount:
+            log.info(f'Убрали {cursor.rowcount} устаревших отложенных операций {operation} над {relay_id}')
+            self.flush()
+
+    def pop_dead_letters(self) -> list[DeadLetter]:
+        letters = []
+        rows = self.connection.execute(
+            'SELECT id, operation, bot_id, platform, chat_id, server_id, message, relay_message_id, text, error '
+            'FROM dead_letters ORDER BY id').fetchall()
+        for letter_id, operation, bot_id, platform, chat_id, server_id, row_id, relay_message_id, text, error in rows:
+            message = self._load_message(row_id)
+            if message is None:
+                log.warning(f'Сообщение неудавшейся операции {letter_id} пропало из базы')
+                continue
+            chat = self._chat_from_key(platform, chat_id, server_id)
+            relay_id = MessageID(chat, relay_message_id) if relay_message_id is not None else None
+            letters.append(DeadLetter(operation, bot_id, chat, message, relay_id=relay_id, text=text, error=error))
+        self.connection.execute('DELETE FROM dead_letters')
+        self.flush()
+        return letters
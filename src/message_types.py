@@ -1,10 +1,36 @@
 from dataclasses import dataclass, field
+import asyncio
 import enum
 import io
 from typing import Optional
 from PIL import Image
 import requests
 
+import http_client
+import image_worker
+
+MAX_FILE_SIZE=1024*1024*5
+# картинки не проверялись на размер при получении, поэтому им оставлен запас побольше
+MAX_IMAGE_SIZE=MAX_FILE_SIZE*4
+DOWNLOAD_TIMEOUT=60
+# сколько байт перекодированных вариантов одной картинки можно держать в памяти
+MAX_ENCODED_CACHE_SIZE=MAX_FILE_SIZE*4
+STICKER_SIZE=(160, 160)
+
+
+def download_sync(url: str, max_size: int) -> bytes:
+    '''
+    Синхронная загрузка для старых вызовов get_image/get_file вне event loop
+    '''
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(http_client.CHUNK_SIZE):
+            data += chunk
+            if len(data) > max_size:
+                raise ValueError(f'Файл {url} больше {max_size} байт')
+        return bytes(data)
+
 
 class Platform(enum.Enum):
     Discord = 0
@@ -30,17 +56,89 @@ class IAttachment:
     def uncache(self):
         ...
 
+    def cached_size(self) -> int:
+        '''
+        Сколько байт памяти сейчас занимают закэшированные данные вложения
+        '''
+        return 0
+
+
+def buffer_reader(buffer: memoryview) -> io.BytesIO:
+    '''
+    Файловый объект для чтения буфера вложения. Если под буфером целый bytes, CPython не копирует его в BytesIO
+    '''
+    if isinstance(buffer.obj, bytes) and buffer.nbytes == len(buffer.obj):
+        return io.BytesIO(buffer.obj)
+    return io.BytesIO(buffer)
+
+
+def image_size(image: Optional[Image.Image]) -> int:
+    if image is None:
+        return 0
+    return image.width * image.height * len(image.getbands())
+
 
 @dataclass
 class IPicture(IAttachment):
+    # (format, size, mode) -> закодированная картинка, общая для всех чатов, куда пересылается сообщение
+    _encoded: dict[tuple[str, Optional[tuple[int, int]], Optional[str]], bytes] = field(default_factory=dict, init=False, repr=False, compare=False)
+    _encode_lock: Optional[asyncio.Lock] = field(default=None, init=False, repr=False, compare=False)
+
     def get_image(self) -> Image.Image:
         ...
 
+    async def encode(self, format: str, size: Optional[tuple[int, int]] = None, mode: Optional[str] = None) -> Optional[bytes]:
+        '''
+        Кодирует картинку в format (с изменением размера и цветового режима) один раз на все send_message
+        '''
+        key = (format, size, mode)
+        if key in self._encoded:
+            return self._encoded[key]
+        if self._encode_lock is None:
+            self._encode_lock = asyncio.Lock()
+        async with self._encode_lock:
+            # пока ждали, другой чат мог уже закодировать
+            if key in self._encoded:
+                return self._encoded[key]
+            source = await self.fetch_data()
+            if source is not None:
+                data = await image_worker.encode(source, format, size, mode)
+            else:
+                image = await self.fetch_image()
+                if image is None:
+                    return None
+                data = await image_worker.encode_decoded(image, format, size, mode)
+            if self._encoded_size() + len(data) <= MAX_ENCODED_CACHE_SIZE:
+                self._encoded[key] = data
+            return data
+
+    def _encoded_size(self) -> int:
+        return sum(len(data) for data in self._encoded.values())
+
+    def uncache(self):
+        self._encoded.clear()
+
+    def cached_size(self) -> int:
+        return self._encoded_size()
+
+    async def fetch_image(self) -> Optional[Image.Image]:
+        '''
+        То же, что get_image, но не блокирует event loop, если картинку надо скачать
+        '''
+        return self.get_image()
+
+    async def fetch_data(self) -> Optional[bytes]:
+        '''
+        Исходные байты картинки (png, jpeg...), если они есть. Их можно кодировать в другом процессе
+        '''
+        return None
+
 
 @dataclass
 class UrlPicture(IPicture):
     url: str = None
     _cached_image: Optional[Image.Image] = field(default=None, init=False, repr=False)
+    _cached_data: Optional[bytes] = field(default=None, init=False, repr=False)
 
     def get_image(self) -> Optional[Image.Image]:
         if self._cached_image:
@@ -50,14 +148,38 @@ class UrlPicture(IPicture):
         except Exception:
             return None
     
+    async def fetch_data(self) -> Optional[bytes]:
+        if self._cached_data:
+            return self._cached_data
+        try:
+            self._cached_data = await http_client.download(self.url, MAX_IMAGE_SIZE)
+        except Exception:
+            return None
+        return self._cached_data
+
+    async def fetch_image(self) -> Optional[Image.Image]:
+        if self._cached_image:
+            return self._cached_image
+        data = await self.fetch_data()
+        if data is None:
+            return None
+        self._cached_image = Image.open(io.BytesIO(data))
+        return self._cached_image
+    
     def _download_image(self) -> Image.Image:
-        buffer = io.BytesIO(requests.get(self.url).content)
-        self._cached_image = Image.open(buffer)
+        if not self._cached_data:
+            self._cached_data = download_sync(self.url, MAX_IMAGE_SIZE)
+        self._cached_image = Image.open(io.BytesIO(self._cached_data))
         return self._cached_image
     
     def uncache(self):
+        super().uncache()
         del self._cached_image
         self._cached_image = None
+        self._cached_data = None
+
+    def cached_size(self) -> int:
+        return image_size(self._cached_image) + len(self._cached_data or b'') + super().cached_size()
 
 
 @dataclass
@@ -79,13 +201,19 @@ class LocalImage(IPicture):
         return self._cached_data
     
     def uncache(self):
+        super().uncache()
         del self._cached_data
         self._cached_data = None
 
+    def cached_size(self) -> int:
+        return image_size(self._cached_data) + super().cached_size()
+
 
 @dataclass
 class TempImage(IPicture):
     cached_image: Optional[Image.Image] = field(default=None, repr=False)
+    # исходные байты картинки, из них cached_image открывается только по требованию
+    cached_data: Optional[bytes] = field(default=None, repr=False)
 
     def set_image(self, image: Image.Image):
         self.cached_image = image
@@ -93,17 +221,37 @@ class TempImage(IPicture):
     def get_image(self) -> Optional[Image.Image]:
         if self.cached_image:
             return self.cached_image
+        if self.cached_data:
+            self.cached_image = Image.open(io.BytesIO(self.cached_data))
+            return self.cached_image
         return None
+
+    async def fetch_data(self) -> Optional[bytes]:
+        return self.cached_data
     
     def uncache(self):
+        super().uncache()
         del self.cached_image
         self.cached_image = None
+        self.cached_data = None
+
+    def cached_size(self) -> int:
+        return image_size(self.cached_image) + len(self.cached_data or b'') + super().cached_size()
 
 
 @dataclass
 class Sticker(IAttachment):
     picture: IPicture = None
 
+    def uncache(self):
+        if self.picture:
+            self.picture.uncache()
+
+    def cached_size(self) -> int:
+        if self.picture:
+            return self.picture.cached_size()
+        return 0
+
 
 @dataclass
 class UrlLink(IAttachment):
@@ -116,6 +264,23 @@ class IFile(IAttachment):
     def get_file(self) -> Optional[bytes]:
         ...
 
+    async def fetch_file(self) -> Optional[bytes]:
+        '''
+        То же, что get_file, но не блокирует event loop, если файл надо скачать
+        '''
+        return self.get_file()
+
+    def get_buffer(self) -> Optional[memoryview]:
+        '''
+        Данные файла как memoryview только для чтения, один буфер на все чаты, куда пересылается сообщение
+        '''
+        data = self.get_file()
+        return None if data is None else memoryview(data).toreadonly()
+
+    async def fetch_buffer(self) -> Optional[memoryview]:
+        data = await self.fetch_file()
+        return None if data is None else memoryview(data).toreadonly()
+
 
 @dataclass
 class UrlFile(IFile):
@@ -130,14 +295,33 @@ class UrlFile(IFile):
         except Exception:
             return None
     
+    async def fetch_file(self) -> Optional[bytes]:
+        if self._cached_data:
+            return self._cached_data
+        try:
+            self._cached_data = await http_client.download(self.url, MAX_FILE_SIZE)
+        except Exception:
+            return None
+        return self._cached_data
+    
     def _download_file(self) -> bytes:
-        self._cached_data = requests.get(self.url).content
+        self._cached_data = download_sync(self.url, MAX_FILE_SIZE)
         return self._cached_data
     
     def uncache(self):
         del self._cached_data
         self._cached_data = None
 
+    def cached_size(self) -> int:
+        return len(self._cached_data or b'')
+
+
+def missing_file_link(file: IFile) -> UrlLink:
+    '''
+    Ссылка вместо файла, который не скачался. Пустой файл с тем же именем отправлять нельзя
+    '''
+    return UrlLink(f'Файл {file.name or "file.dat"} не был загружен', getattr(file, 'url', None) or '')
+
 
 @dataclass
 class LocalFile(IFile):
@@ -161,6 +345,9 @@ class LocalFile(IFile):
         del self._cached_data
         self._cached_data = None
 
+    def cached_size(self) -> int:
+        return len(self._cached_data or b'')
+
 
 @dataclass
 class TempFile(IFile):
@@ -178,6 +365,9 @@ class TempFile(IFile):
         del self.cached_data
         self.cached_data = None
 
+    def cached_size(self) -> int:
+        return len(self.cached_data or b'')
+
 @dataclass
 class Author:
     platform: Platform
@@ -199,7 +389,7 @@ class MessageID:
         return hash((self.chat, self.id))
 
 
-@dataclass
+@dataclass(eq=False)
 class Message:
     original_id: MessageID
     author: Author
@@ -221,10 +411,16 @@ class Message:
     def __hash__(self):
         return hash(self.original_id)
 
+    def __eq__(self, other: object) -> bool:
+        # сообщение однозначно определяется своим original_id, сравнивать текст, вложения и цепочки ответов незачем
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.original_id == other.original_id
+
     def get_data(self, chat: Chat, key: str, default=None):
         if key not in self.data:
             return default
-        return self.data[key][chat]
+        return self.data[key].get(chat, default)
 
     def set_data(self, chat: Chat, key: str, value: object):
         if key not in self.data:
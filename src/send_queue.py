@@ -0,0 +1,198 @@
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
+import asyncio
+import logging
+import random
+import time
+
+log = logging.getLogger('main')
+
+T = TypeVar('T')
+
+DEFAULT_MAX_PARALLEL_SENDS = 4
+DEFAULT_MAX_RATE_LIMIT_RETRIES = 5
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 30.0
+
+
+class PartialSendError(Exception):
+    '''
+    Отправка из нескольких запросов оборвалась на середине. sent - id сообщений, которые уже ушли,
+    причина лежит в __cause__
+    '''
+    def __init__(self, sent: list):
+        super().__init__(f'до ошибки отправлено сообщений: {len(sent)}')
+        self.sent = sent
+
+
+@dataclass
+class TokenBucket:
+    '''
+    rate токенов в секунду, не больше capacity подряд. Ждущие получают токены по очереди
+    '''
+    rate: float
+    capacity: float
+    tokens: float = field(default=None, init=False)
+    updated_at: float = field(default_factory=time.monotonic, init=False)
+    # до этого момента токены не выдаются: так выполняется retry-after от платформы
+    blocked_until: float = field(default=0.0, init=False)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        self.tokens = self.capacity
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1) -> float:
+        '''
+        Забирает tokens токенов, возвращает сколько секунд пришлось ждать. Если просят больше capacity,
+        ждём полного ведра и уходим в минус, тогда следующие подождут, пока долг восстановится
+        '''
+        started = time.monotonic()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return time.monotonic() - started
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+@dataclass
+class SendQueue:
+    '''
+    Исходящая очередь бота: сообщения в один чат уходят строго по порядку, скорость ограничивается
+    токенами на бота и на чат, а если платформа всё равно ответила "слишком часто", запрос
+    повторяется после указанной ей паузы, а не теряется. Временные ошибки (сеть, 5xx)
+    повторяются с экспоненциальной паузой со случайным разбросом.
+    Лимиты и повторы действуют на один запрос к платформе (request), порядок - на всю
+    отправку (ordered), иначе повтор отправки из нескольких запросов продублировал бы уже ушедшее
+    '''
+    # сколько секунд ждать перед повтором, None - ошибка не про лимиты
+    retry_after: Callable[[Exception], Optional[float]]
+    # временная ли ошибка, которую стоит повторить
+    is_transient: Callable[[Exception], bool] = field(default=lambda e: False, repr=False)
+    rate: Optional[float] = None
+    burst: Optional[float] = None
+    chat_rate: Optional[float] = None
+    chat_burst: Optional[float] = None
+    max_parallel: int = DEFAULT_MAX_PARALLEL_SENDS
+    max_retries: int = DEFAULT_MAX_RATE_LIMIT_RETRIES
+    retries: int = DEFAULT_RETRIES
+    retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY
+    retry_max_delay: float = DEFAULT_RETRY_MAX_DELAY
+
+    bucket: Optional[TokenBucket] = field(default=None, init=False, repr=False)
+    chat_buckets: dict[Hashable, TokenBucket] = field(default_factory=dict, init=False, repr=False)
+    chat_locks: dict[Hashable, asyncio.Lock] = field(default_factory=dict, init=False, repr=False)
+    semaphore: asyncio.Semaphore = field(default=None, init=False, repr=False)
+
+    sent: int = 0
+    delayed: int = 0
+    delayed_seconds: float = 0.0
+    rate_limited: int = 0
+    retried: int = 0
+    dead_letters: int = 0
+    replayed: int = 0
+
+    def __post_init__(self):
+        if self.rate:
+            self.bucket = TokenBucket(self.rate, self.burst or self.rate)
+        self.semaphore = asyncio.Semaphore(self.max_parallel)
+
+    def _chat_bucket(self, chat: Hashable) -> Optional[TokenBucket]:
+        if not self.chat_rate:
+            return None
+        bucket = self.chat_buckets.get(chat)
+        if bucket is None:
+            bucket = self.chat_buckets[chat] = TokenBucket(self.chat_rate, self.chat_burst or 1)
+        return bucket
+
+    async def _acquire(self, chat_bucket: Optional[TokenBucket], cost: float):
+        waited = 0.0
+        if chat_bucket:
+            waited += await chat_bucket.acquire(cost)
+        if self.bucket:
+            waited += await self.bucket.acquire(cost)
+        if waited > 0.001:
+            self.delayed += 1
+            self.delayed_seconds += waited
+
+    def ordered(self, chat: Hashable) -> asyncio.Lock:
+        '''
+        Блокировка чата: asyncio.Lock отпускает ждущих в порядке очереди, так сохраняется порядок
+        сообщений в чате. Повторы тоже идут под ней, чтобы следующее сообщение не обогнало неудавшееся
+        '''
+        return self.chat_locks.setdefault(chat, asyncio.Lock())
+
+    async def run(self, chat: Hashable, operation: Callable[[], Awaitable[T]]) -> T:
+        '''
+        Выполняет operation (отправку, редактирование, удаление) из одного запроса в чат chat
+        по порядку и с учётом лимитов
+        '''
+        async with self.ordered(chat):
+            return await self.request(chat, operation)
+
+    async def request(self, chat: Hashable, operation: Callable[[], Awaitable[T]], cost: float = 1) -> T:
+        '''
+        Выполняет один запрос к платформе с учётом лимитов и повторяет его при ошибках.
+        cost - сколько сообщений в чате он создаёт, например у альбома по одному на картинку
+        '''
+        chat_bucket = self._chat_bucket(chat)
+        attempt = 0
+        failures = 0
+        while True:
+            await self._acquire(chat_bucket, cost)
+            try:
+                async with self.semaphore:
+                    result = await operation()
+            except Exception as e:
+                delay = self.retry_after(e)
+                if delay is None:
+                    if not self.is_transient(e) or failures >= self.retries:
+                        raise
+                    # full jitter: случайная пауза до base * 2^n, чтобы повторы разных чатов не шли волной
+                    delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** failures))
+                    failures += 1
+                    self.retried += 1
+                    log.warning(f'Временная ошибка в чате {chat}: {e}, повтор {failures} через {delay:.1f} с')
+                    await asyncio.sleep(delay)
+                    continue
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.rate_limited += 1
+                log.warning(f'Лимит платформы в чате {chat}, повтор {attempt} через {delay:.1f} с')
+                # лимиты платформ в основном на чат, поэтому остальные чаты бота не останавливаем
+                if chat_bucket:
+                    chat_bucket.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                continue
+            self.sent += 1
+            return result
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'sent': self.sent,
+            'delayed': self.delayed,
+            'delayed_seconds': round(self.delayed_seconds, 3),
+            'rate_limited': self.rate_limited,
+            'retried': self.retried,
+            'dead_letters': self.dead_letters,
+            'replayed': self.replayed,
+        }
@@ -1,6 +1,7 @@
 from datetime import datetime
 import os
 import uuid
+from typing import Awaitable, Callable
 
 import aiogram.filters
 import aiogram.utils.markdown as mdutils
@@ -13,12 +14,93 @@ import aiogram
 from aiogram.methods import GetUserProfilePhotos
 from aiogram_media_group import media_group_handler
 
+# аватарки в discord показываются маленькими, больше этого размера скачивать незачем
+DEFAULT_AVATAR_SIZE = 160
+
+
+class MemoryInputFile(aiogram.types.InputFile):
+    '''
+    Как BufferedInputFile, но отдаёт куски через memoryview, не копируя данные вложения
+    '''
+    def __init__(self, data: bytes | memoryview, filename: str, chunk_size: int = aiogram.types.input_file.DEFAULT_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.data = memoryview(data)
+
+    async def read(self, bot: aiogram.Bot):
+        for start in range(0, len(self.data), self.chunk_size):
+            yield self.data[start:start + self.chunk_size]
+
+
+@dataclass
+class TelegramAvatar(IPicture):
+    '''
+    Аватарка пользователя телеграма, которая скачивается только когда кому-то понадобится.
+    Берётся самый маленький размер, который не меньше min_size
+    '''
+    bot: aiogram.Bot = field(default=None, repr=False)
+    user_id: int = None
+    min_size: int = DEFAULT_AVATAR_SIZE
+    _cached_data: Optional[bytes] = field(default=None, init=False, repr=False)
+    # аватарку уже искали, повторно в телеграм не ходим, даже если её нет
+    _resolved: bool = field(default=False, init=False, repr=False)
+    _fetch_lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+
+    def _pick_size(self, sizes: list[aiogram.types.PhotoSize]) -> aiogram.types.PhotoSize:
+        for size in sorted(sizes, key=lambda s: s.width * s.height):
+            if min(size.width, size.height) >= self.min_size:
+                return size
+        return max(sizes, key=lambda s: s.width * s.height)
+
+    async def fetch_data(self) -> Optional[bytes]:
+        async with self._fetch_lock:
+            if self._resolved:
+                return self._cached_data
+            photos = await self.bot.get_user_profile_photos(self.user_id, limit=1)
+            if len(photos.photos) > 0 and len(photos.photos[0]) > 0:
+                size = self._pick_size(photos.photos[0])
+                buf = io.BytesIO()
+                await self.bot.download(size.file_id, buf)
+                self._cached_data = buf.getvalue()
+                log.debug(f'Скачали аватарку {self.user_id} размером {size.width}x{size.height}')
+            else:
+                log.debug('У пользователя нет фото в профиле.')
+            self._resolved = True
+            return self._cached_data
+
+    def get_image(self) -> Optional[Image.Image]:
+        if self._cached_data is None:
+            return None
+        return Image.open(io.BytesIO(self._cached_data))
+
+    async def fetch_image(self) -> Optional[Image.Image]:
+        data = await self.fetch_data()
+        if data is None:
+            return None
+        return Image.open(io.BytesIO(data))
+
+    def uncache(self):
+        super().uncache()
+        self._cached_data = None
+        self._resolved = False
+
+    def cached_size(self) -> int:
+        return len(self._cached_data or b'') + super().cached_size()
+
 @dataclass
 class TelegramBot(IBot):
     platform: Platform = field(default=Platform.Telegram, init=False)
     settings: dict[str, object] = field(default_factory=dict)
     bot: aiogram.Bot = field(default=None, init=False)
     task: asyncio.Task = field(default=None, init=False)
+    # aiogram обрабатывает каждый update отдельной задачей, а синхронные фильтры гоняет через
+    # run_in_executor, так что update одного чата могут дойти до обработчика не в том порядке.
+    # Эта блокировка берётся в outer middleware, ещё до фильтров, и держится пока update обрабатывается
+    update_sequencers: dict[Chat, asyncio.Lock] = field(default_factory=dict, init=False, repr=False)
+
+    # телеграм разрешает боту около 30 сообщений в секунду и 20 сообщений в минуту в одну группу
+    DEFAULT_RATE_LIMIT = 30
+    DEFAULT_CHAT_RATE_LIMIT = 20
+    DEFAULT_CHAT_BURST = 3
 
     def _is_message_from_this_bot(self, native_message: aiogram.types.Message) -> bool:
         return native_message.from_user.id == self.bot.id
@@ -26,7 +108,7 @@ class TelegramBot(IBot):
     def _message_preview_for_log(self, native_message: aiogram.types.Message) -> str:
         return f'{native_message.from_user.full_name}: {native_message.text[:20]}'
 
-    def _message_id_from_native(self, chat: Chat, native_message: aiogram.types.Message):
+    async def _message_id_from_native(self, chat: Chat, native_message: aiogram.types.Message):
         return MessageID(chat, native_message.message_id)
     
     async def _handle_new_media_group_message(self, native_messages: list[aiogram.types.Message]):
@@ -38,15 +120,30 @@ class TelegramBot(IBot):
             log.debug(f'Сообщение не из моего чата: {self._message_preview_for_log(native_messages[0])}')
             return
 
-        message = await self.create_message_from_native_media_group(native_messages, chat, True)
-        self.coordinator.db_add_message(message)
-        await self.coordinator.send_all(message)
+        async with self.chat_sequencer(chat):
+            message = await self.create_message_from_native_media_group(native_messages, chat, True)
+            self.coordinator.db_add_message(message)
+            await self.coordinator.send_all(message)
 
     def __post_init__(self):
         self.bot = aiogram.Bot(token=self.settings['token'])
 
         self.dp = aiogram.Dispatcher()
 
+        @self.dp.update.outer_middleware()
+        async def sequence_updates(handler, update: aiogram.types.Update, data):
+            native_message = update.message or update.edited_message
+            chat = native_message and self.get_current_chat_from_native_message(native_message)
+            if not chat:
+                return await handler(update, data)
+            # задачи update запускаются в порядке прихода и доходят сюда без единого await,
+            # поэтому FIFO блокировка выстраивает update чата в этом же порядке
+            lock = self.update_sequencers.get(chat)
+            if lock is None:
+                lock = self.update_sequencers[chat] = asyncio.Lock()
+            async with lock:
+                return await handler(update, data)
+
         @self.dp.message(aiogram.F.media_group_id == None)
         async def on_message(native_message: aiogram.types.Message):
             await self._handle_new_message(native_message)
@@ -63,43 +160,44 @@ class TelegramBot(IBot):
     def get_current_chat_from_native_message(self, message: aiogram.types.Message):
         return self.get_current_chat(Platform.Telegram, None, message.chat.id)
     
-    async def get_author(self, user: aiogram.types.User):
-        author = self.coordinator.get_author(Platform.Telegram, user.id)
-        if author: 
-            return author
-        pfp = None
-        user_profile_photo: aiogram.types.UserProfilePhotos = await self.bot.get_user_profile_photos(user.id, limit=1)
-        if len(user_profile_photo.photos) > 0 and len(user_profile_photo.photos[0]) > 0:
-            file = await self.bot.get_file(user_profile_photo.photos[0][-1].file_id)
-            buf = io.BytesIO()
-            await self.bot.download_file(file.file_path, buf)
-            pfp = TempImage('pfp.png', Image.open(buf))
-        else:
-            log.debug('У пользователя нет фото в профиле.')
-        # if len(profile_photos.photos) >= 1:
-        #     pfp = UrlPicture(f'pfp of {user.full_name}', profile_photos.photos[0])
-        author = Author(Platform.Telegram, id=user.id, 
-                        name=user.full_name, 
-                        username=user.username, pfp=pfp)
-        self.coordinator.add_author(author)
-        return author
-
-    async def create_message_from_native(self, native_message: aiogram.types.Message, chat: Chat, retrieve_from_db=True) -> Optional[Message]:
+    def _retry_after(self, exception: Exception) -> Optional[float]:
+        if isinstance(exception, aiogram.exceptions.TelegramRetryAfter):
+            return exception.retry_after
+        return None
+
+    def _is_transient(self, exception: Exception) -> bool:
+        return (isinstance(exception, (aiogram.exceptions.TelegramNetworkError, aiogram.exceptions.TelegramServerError))
+                or super()._is_transient(exception))
+
+    def _author_id_from_native(self, user: aiogram.types.User) -> int:
+        return user.id
+
+    async def _fetch_author(self, user: aiogram.types.User) -> Author:
+        # сама аватарка скачается, только если её попросит discord вебхук
+        pfp = TelegramAvatar('pfp.png', bot=self.bot, user_id=user.id,
+                             min_size=self.settings.get('avatar_size', DEFAULT_AVATAR_SIZE))
+        return Author(Platform.Telegram, id=user.id, 
+                      name=user.full_name, 
+                      username=user.username, pfp=pfp)
+
+    async def create_message_from_native(self, native_message: aiogram.types.Message, chat: Chat, retrieve_from_db=True, depth: int = 0,
+                                         with_attachments: bool = True) -> Optional[Message]:
         if native_message is None:
             return None
-        message_id = self._message_id_from_native(chat, native_message)
+        message_id = await self._message_id_from_native(chat, native_message)
         if retrieve_from_db:
             message = self.coordinator.db_get_message(message_id)
             if message:
                 return message
         reply_to = None
-        if native_message.reply_to_message:
+        if native_message.reply_to_message and self.can_resolve_reply(depth):
             try:
-                reply_to = await self.create_message_from_native(native_message.reply_to_message, chat)
+                reply_to = await self.create_message_from_native(native_message.reply_to_message, chat, depth=depth + 1)
             except Exception:
                 log.warning('Не получилось получить reference сообщение')
         
-        attachments = await self.get_attachments_from_natives([native_message])
+        # у медиагруппы вложения скачиваются все вместе в create_message_from_native_media_group
+        attachments = await self.get_attachments_from_natives([native_message]) if with_attachments else []
 
         message = Message(message_id,
                             author=await self.get_author(native_message.from_user),
@@ -107,27 +205,37 @@ class TelegramBot(IBot):
                             attachments=attachments)
         return message
 
+    async def _download(self, file_id: str) -> bytes:
+        '''
+        Скачивает файл телеграма в память. getvalue отдаёт внутренний буфер BytesIO без копирования
+        '''
+        buf = io.BytesIO()
+        await self.bot.download(file_id, buf)
+        return buf.getvalue()
+
+    async def _download_document(self, document: aiogram.types.Document) -> IAttachment:
+        return TempFile(document.file_name, cached_data=await self._download(document.file_id))
+
+    async def _download_photo(self, photo: aiogram.types.PhotoSize) -> IAttachment:
+        return TempImage(cached_data=await self._download(photo.file_id))
+
+    async def _download_sticker(self, native_sticker: aiogram.types.Sticker) -> IAttachment:
+        return Sticker(native_sticker.emoji, TempImage(cached_data=await self._download(native_sticker.file_id)))
+
     async def get_attachments_from_natives(self, native_messages: list[aiogram.types.Message]):
-        attachments = []
+        # вложения всех сообщений медиагруппы скачиваются одновременно, порядок сохраняется
+        attachments: list[IAttachment | Awaitable[IAttachment]] = []
         for native in native_messages:
             if native.document:
                 if native.document.file_size <= MAX_FILE_SIZE:
-                    buf = io.BytesIO()
-                    await self.bot.download(file=native.document.file_id, destination=buf)
-                    buf.seek(0)
-                    file = TempFile(native.document.file_name, cached_data=buf.read())
-                    attachments.append(file)
+                    attachments.append(self._download_document(native.document))
                 else:
                     # TODO как-то оповестить что файл не отправлен
                     log.warning("Файл слишком большой")
                     attachments.append(UrlLink('Файл слишком большой и не был загружен', ''))
             
             if native.photo:
-                buf = io.BytesIO()
-                await self.bot.download(native.photo[-1].file_id, buf)
-                buf.seek(0)
-                img = TempImage(cached_image=Image.open(buf))
-                attachments.append(img)
+                attachments.append(self._download_photo(native.photo[-1]))
             
             if native.sticker:
                 if native.sticker.is_animated:
@@ -135,21 +243,18 @@ class TelegramBot(IBot):
                 elif native.sticker.is_video:
                     attachments.append(UrlLink('Ошибка: видео стикеры не поддерживаются', ''))
                 else:
-                    buf = io.BytesIO()
-                    await self.bot.download(native.sticker.file_id, buf)
-                    buf.seek(0)
-                    img = TempImage(cached_image=Image.open(buf))
-                    attachments.append(Sticker(native.sticker.emoji, img))
-        return attachments
+                    attachments.append(self._download_sticker(native.sticker))
+
+        downloads = [attachment for attachment in attachments if not isinstance(attachment, IAttachment)]
+        downloaded = iter(await asyncio.gather(*downloads))
+        return [attachment if isinstance(attachment, IAttachment) else next(downloaded) for attachment in attachments]
     
     async def create_message_from_native_media_group(self, native_messages: list[aiogram.types.Message], chat: Chat, retrieve_from_db=True) -> Optional[Message]:
-        message = await self.create_message_from_native(native_messages[0], chat, retrieve_from_db)
+        message = await self.create_message_from_native(native_messages[0], chat, retrieve_from_db, with_attachments=False)
         if not isinstance(message, Message):
             return
         
-        attachments = await self.get_attachments_from_natives(native_messages[1:])
-
-        message.attachments += attachments
+        message.attachments += await self.get_attachments_from_natives(native_messages)
         return message
     
     def is_running(self) -> bool:
@@ -159,6 +264,11 @@ class TelegramBot(IBot):
         self.task = asyncio.create_task(self.dp.start_polling(self.bot))
         log.info(f"Бот telegram {self.display_name()} запущен")
 
+    async def queue_send(self, chat: Chat, message: Message) -> list[MessageID]:
+        # send_message делает несколько запросов, лимиты и повторы у каждого свои, а порядок общий
+        async with self.get_send_queue().ordered(chat):
+            return await self.send_message(chat, message)
+
     def stop(self):
         asyncio.create_task(self.dp.stop_polling())
         # self.task.cancel()
@@ -196,24 +306,27 @@ class TelegramBot(IBot):
         videos = []
         for attachment in message.attachments:
             if isinstance(attachment, IPicture):
-                image = attachment.get_image()
-                buffer = io.BytesIO()
-                image.convert('RGB').save(buffer, format='jpeg')
-                buffer.seek(0)
-                file_data = aiogram.types.input_file.BufferedInputFile(buffer.read(), attachment.name or 'image.jpeg')
+                image_data = await attachment.encode('jpeg', mode='RGB')
+                if image_data is None:
+                    log.warning(f'Картинку {attachment.name} не получилось достать, пропускаем')
+                    continue
+                file_data = MemoryInputFile(image_data, attachment.name or 'image.jpeg')
                 file = aiogram.types.InputMediaPhoto(media=file_data, caption=(attachment.name + '.jpg' or 'image.jpeg'))
                 pictures.append(file)
             elif isinstance(attachment, Sticker):
-                image = attachment.picture.get_image()
-                buffer = io.BytesIO()
-                image.resize((160, 160)).save(buffer, format='webp')
-                buffer.seek(0)
-                sticker = aiogram.types.input_file.BufferedInputFile(buffer.read(), attachment.name or 'image.webp')
+                image_data = await attachment.picture.encode('webp', STICKER_SIZE)
+                if image_data is None:
+                    log.warning(f'Стикер {attachment.name} не получилось достать, пропускаем')
+                    continue
+                sticker = MemoryInputFile(image_data, attachment.name or 'image.webp')
             elif isinstance(attachment, IFile):
-                file_data = attachment.get_file()
-                buffer = io.BytesIO(file_data)
-                buffer.seek(0)
-                file_data = aiogram.types.input_file.BufferedInputFile(buffer.read(), attachment.name or 'file.dat')
+                buffer = await attachment.fetch_buffer()
+                if buffer is None:
+                    log.warning(f'Файл {attachment.name} не скачался, отправляем вместо него ссылку')
+                    link = missing_file_link(attachment)
+                    links += f'[{link.name}]({link.url}) '
+                    continue
+                file_data = MemoryInputFile(buffer, attachment.name or 'file.dat')
                 file = aiogram.types.InputMediaDocument(media=file_data, filename=(attachment.name or 'file.dat'))
                 documents.append(file)
             elif isinstance(attachment, UrlLink):
@@ -223,62 +336,78 @@ class TelegramBot(IBot):
         message.set_data(chat, 'links', links)
         message.set_data(chat, 'reply_message_id', reply_message_id)
 
-        first_sent_message = None
-        ids = []
+        # части сообщения уходят отдельными запросами, каждый со своими лимитами и повторами.
+        # Отправленные части запоминаются, чтобы повтор из dead letters не продублировал их
+        sent_parts: list[str] = message.get_data(chat, 'sent_parts', [])
+        parts: list[tuple[str, int, Callable[[], Awaitable[list[aiogram.types.Message]]]]] = []
 
         if len(pictures) == 0 and len(documents) == 0:
             if message.text is not None or message.text != '' or sticker:
-                first_sent_message = await self.bot.send_message(chat_id=chat.id, text=content or '', reply_to_message_id=reply_message_id,
-                                                                 parse_mode=ParseMode.MARKDOWN_V2)
+                async def send_text(text=content or ''):
+                    return [await self.bot.send_message(chat_id=chat.id, text=text, reply_to_message_id=reply_message_id,
+                                                        parse_mode=ParseMode.MARKDOWN_V2)]
+                parts.append(('text', 1, send_text))
                 content = message.author.name + ':'
-                ids.append(first_sent_message.message_id)
         
         if sticker:
-            sent_message = await self.bot.send_sticker(chat_id=chat.id, sticker=sticker, reply_to_message_id=reply_message_id)
-            ids.append(sent_message.message_id)
+            async def send_sticker():
+                return [await self.bot.send_sticker(chat_id=chat.id, sticker=sticker, reply_to_message_id=reply_message_id)]
+            parts.append(('sticker', 1, send_sticker))
         
         caption = content or ''
 
         if len(pictures) >= 2:
             pictures[0].caption = caption
-            sent_messages = await self.bot.send_media_group(chat_id=chat.id, media=pictures, reply_to_message_id=reply_message_id, request_timeout=120)
-            for sm in sent_messages:
-                ids.append(sm.message_id)
-            if first_sent_message is None:
-                first_sent_message = sent_messages[0]
+            async def send_pictures():
+                return await self.bot.send_media_group(chat_id=chat.id, media=pictures, reply_to_message_id=reply_message_id, request_timeout=120)
+            parts.append(('pictures', len(pictures), send_pictures))
         elif len(pictures) == 1:
-            sent_message = await self.bot.send_photo(chat_id=chat.id, photo=pictures[0].media, caption=caption, reply_to_message_id=reply_message_id, request_timeout=120)
-            ids.append(sent_message.message_id)
-            if first_sent_message is None:
-                first_sent_message = sent_message
+            async def send_pictures():
+                return [await self.bot.send_photo(chat_id=chat.id, photo=pictures[0].media, caption=caption, reply_to_message_id=reply_message_id, request_timeout=120)]
+            parts.append(('pictures', 1, send_pictures))
         
         if len(documents) >= 2:
             documents[0].caption = caption
-            sent_messages = await self.bot.send_media_group(chat_id=chat.id, media=documents, reply_to_message_id=reply_message_id, request_timeout=120)
-            for sm in sent_messages:
-                ids.append(sm.message_id)
-            if first_sent_message is None:
-                first_sent_message = sent_messages[0]
+            async def send_documents():
+                return await self.bot.send_media_group(chat_id=chat.id, media=documents, reply_to_message_id=reply_message_id, request_timeout=120)
+            parts.append(('documents', len(documents), send_documents))
         elif len(documents) == 1:
-            sent_message = await self.bot.send_document(chat_id=chat.id, document=documents[0].media, caption=caption, reply_to_message_id=reply_message_id, request_timeout=120)
-            ids.append(sent_message.message_id)
-            if first_sent_message is None:
-                first_sent_message = sent_message
+            async def send_documents():
+                return [await self.bot.send_document(chat_id=chat.id, document=documents[0].media, caption=caption, reply_to_message_id=reply_message_id, request_timeout=120)]
+            parts.append(('documents', 1, send_documents))
+
+        ids = []
+        queue = self.get_send_queue()
+        for name, cost, send in parts:
+            if name in sent_parts:
+                continue
+            try:
+                sent_messages = await queue.request(chat, send, cost)
+            except Exception as e:
+                if ids:
+                    raise PartialSendError([MessageID(chat, mid) for mid in ids]) from e
+                raise
+            ids += [sm.message_id for sm in sent_messages]
+            # текст уходит подписью к картинкам или файлам, после перезапуска они могут не сохраниться
+            sent_parts = sent_parts + ([name, 'text'] if name in ('pictures', 'documents') else [name])
+            message.set_data(chat, 'sent_parts', sent_parts)
 
         return [MessageID(chat, mid) for mid in ids] 
 
     async def edit_message(self, message_id: MessageID, new_message: Message):
         old_message = self.coordinator.db_get_message(message_id)
-
-        if old_message and old_message.text == new_message.text:
-            log.debug('Телеграм не разрешает редактировать сообщение одинаковым текстом')
-            return
-
+        # одинаковый текст отсекает Coordinator.edit_all. Здесь не проверяем: в базе может быть текст,
+        # до которого пересылка так и не отредактировалась, и повтор из dead letters бы пропал
         links = old_message.get_data(message_id.chat, 'links')
         reply_message_id = old_message.get_data(message_id.chat, 'reply_message_id')
         new_message.reply_to = old_message.reply_to
         content = self.format_message(new_message, links, include_reply=(reply_message_id is None))
-        await self.bot.edit_message_text(text=content, chat_id=message_id.chat.id, message_id=message_id.id, parse_mode=ParseMode.MARKDOWN_V2)
+        try:
+            await self.bot.edit_message_text(text=content, chat_id=message_id.chat.id, message_id=message_id.id, parse_mode=ParseMode.MARKDOWN_V2)
+        except aiogram.exceptions.TelegramBadRequest as e:
+            if 'message is not modified' not in e.message:
+                raise
+            log.debug('Телеграм не разрешает редактировать сообщение одинаковым текстом')
 
     async def delete_message(self, message_id: MessageID):
         await self.bot.delete_message(message_id.chat.id, message_id.id)
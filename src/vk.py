@@ -1,13 +1,42 @@
 from worker_types import *
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import functools
+import time
+import aiohttp
 import vk_api
 import vk_api.bot_longpoll
 from vk_api import VkUpload
 from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType, VkBotMessageEvent, DotDict as VkDotDict
 import random
 
+from batching import Batcher
+import http_client
+
 VK_CONVERSATION_ID = 2000000000
+DEFAULT_API_WORKERS = 4
+# сколько секунд сервер VK держит запрос long poll, если событий нет
+DEFAULT_LONGPOLL_WAIT = 25
+LONGPOLL_BACKOFF_START = 1
+LONGPOLL_BACKOFF_MAX = 60
+# messages.getByConversationMessageId принимает до 100 id за раз
+MAX_CMIDS_PER_CALL = 100
+MESSAGE_ITEMS_CACHE_SIZE = 5000
+# users.get принимает до 1000 id за раз
+MAX_USERS_PER_CALL = 1000
+DEFAULT_AUTHOR_BATCH_WINDOW = 0.05
+USER_FIELDS = 'photo_max_orig,screen_name'
+DEFAULT_MAX_PARALLEL_UPLOADS = 4
+# сколько секунд переиспользуем адрес сервера загрузки, прежде чем запросить новый
+UPLOAD_SERVER_TTL = 10 * 60
+# ключ группы может делать 20 запросов в секунду, vk_api по умолчанию ограничивает себя тремя
+DEFAULT_API_RATE_LIMIT = 20
+# ошибки "слишком много запросов в секунду" и "flood control"
+TOO_MANY_REQUESTS_CODE = 6
+FLOOD_CONTROL_CODE = 9
+FLOOD_CONTROL_DELAY = 5
 
 @dataclass
 class VkBot(IBot):
@@ -16,63 +45,179 @@ class VkBot(IBot):
     longpoll: VkBotLongPoll = field(default=None, init=False)
     task: asyncio.Task = field(default=None, init=False)
     upload: VkUpload = field(default=None, init=False)
+    # vk_api синхронный, поэтому все запросы идут через свои потоки, а не в event loop
+    executor: ThreadPoolExecutor = field(default=None, init=False, repr=False)
+    poll_executor: ThreadPoolExecutor = field(default=None, init=False, repr=False)
+    # peer_id -> батчер запросов conversation_message_id этой беседы
+    cmid_batchers: dict[int, Batcher[int, dict]] = field(default_factory=dict, init=False, repr=False)
+    # (peer_id, conversation_message_id) -> сообщение из API с настоящим id
+    message_items: OrderedDict[tuple[int, int], dict] = field(default_factory=OrderedDict, init=False, repr=False)
+    user_batcher: Batcher[int, dict] = field(default=None, init=False, repr=False)
+    # (тип загрузки, peer_id) -> (адрес сервера загрузки, когда получен)
+    upload_servers: dict[tuple[str, int], tuple[str, float]] = field(default_factory=dict, init=False, repr=False)
+    upload_semaphore: Optional[asyncio.Semaphore] = field(default=None, init=False, repr=False)
+    # ссылки на задачи обработки событий, чтобы их не собрал сборщик мусора
+    event_tasks: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
 
     def __post_init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.settings.get('api_workers', DEFAULT_API_WORKERS),
+                                           thread_name_prefix=f'vk-{self.id}')
+        self.poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'vk-{self.id}-longpoll')
+        self.user_batcher = Batcher(self._fetch_users, window=self.settings.get('author_batch_window', DEFAULT_AUTHOR_BATCH_WINDOW),
+                                    max_batch=MAX_USERS_PER_CALL)
         self.vk_api = vk_api.VkApi(token=self.settings['token'])
+        # vk_api сам выдерживает паузу между запросами, это и есть лимит на ключ
+        self.vk_api.RPS_DELAY = 1 / self.settings.get('api_rate_limit', DEFAULT_API_RATE_LIMIT)
         self.api = self.vk_api.get_api()
         data = self.api.groups.get_by_id()
         group_id = data[0]['id']
         self.upload = VkUpload(self.api)
-        self.longpoll = VkBotLongPoll(self.vk_api, group_id=group_id, wait=0) # потому что longpoll.check добавляет 10 к запросу
+        # check сам обновляет ts и key, если сервер ответил failed, а таймаут запроса ставит wait + 10
+        self.longpoll = VkBotLongPoll(self.vk_api, group_id=group_id, wait=self.settings.get('longpoll_wait', DEFAULT_LONGPOLL_WAIT))
 
     def _is_message_from_this_bot(self, native_message: dict) -> bool:
         return False
 
+    def _retry_after(self, exception: Exception) -> Optional[float]:
+        if isinstance(exception, vk_api.exceptions.ApiError):
+            if exception.code == TOO_MANY_REQUESTS_CODE:
+                return 1
+            if exception.code == FLOOD_CONTROL_CODE:
+                return FLOOD_CONTROL_DELAY
+        return None
+
+    def _is_transient(self, exception: Exception) -> bool:
+        return isinstance(exception, vk_api.exceptions.ApiHttpError) or super()._is_transient(exception)
+
     def _message_preview_for_log(self, native_message: dict) -> str:
         return native_message['text'][:20]
 
-    def _message_id_from_native(self, chat: Chat, native_message: dict):
-        conversation_message_id = native_message['conversation_message_id']
-        get_by_id_response = self.api.messages.get_by_conversation_message_id(peer_id=VK_CONVERSATION_ID+chat.id, 
-            conversation_message_ids=str(conversation_message_id), 
+    async def _call(self, method, *args, **kwargs):
+        """
+        Выполняет синхронный вызов vk_api в пуле потоков бота
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def _get_message_item(self, peer_id: int, conversation_message_id: int) -> dict:
+        """
+        Возвращает сообщение по conversation_message_id. Запросы в одну беседу объединяются в один вызов API
+        """
+        key = (peer_id, conversation_message_id)
+        if key in self.message_items:
+            self.message_items.move_to_end(key)
+            return self.message_items[key]
+        batcher = self.cmid_batchers.get(peer_id)
+        if batcher is None:
+            batcher = Batcher(functools.partial(self._fetch_message_items, peer_id), max_batch=MAX_CMIDS_PER_CALL)
+            self.cmid_batchers[peer_id] = batcher
+        return await batcher.get(conversation_message_id)
+
+    async def _fetch_message_items(self, peer_id: int, conversation_message_ids: list[int]) -> dict[int, dict]:
+        response = await self._call(self.api.messages.get_by_conversation_message_id, peer_id=peer_id,
+            conversation_message_ids=','.join(map(str, conversation_message_ids)),
             extended=False)
-        message_data = get_by_id_response['items'][0]
-        message_id = message_data['id']
-        return MessageID(chat, message_id)
+        log.debug(f'Получили {len(response["items"])} сообщений вк одним запросом')
+        result = dict()
+        for item in response['items']:
+            self._remember_message_item(peer_id, item)
+            result[item['conversation_message_id']] = item
+        return result
+
+    def _remember_message_item(self, peer_id: int, item: dict):
+        self.message_items[(peer_id, item['conversation_message_id'])] = item
+        while len(self.message_items) > MESSAGE_ITEMS_CACHE_SIZE:
+            self.message_items.popitem(last=False)
+
+    async def _prefetch_message_items(self, events: list):
+        """
+        Запрашивает id всех сообщений пачки событий и их ответов заранее, чтобы они ушли в API вместе
+        """
+        lookups = []
+        for event in events:
+            if not isinstance(event, VkBotMessageEvent) or not event.message:
+                continue
+            native_message = event.message
+            if self.get_current_chat_from_native_message(native_message) is None:
+                continue
+            if native_message.get('id'):
+                # в событии уже есть настоящий id, запоминаем его как есть, чтобы ответы на него не ходили в API
+                self._remember_message_item(native_message.peer_id, native_message)
+            else:
+                lookups.append(self._get_message_item(native_message.peer_id, native_message['conversation_message_id']))
+            if 'reply_message' in native_message:
+                lookups.append(self._get_message_item(native_message.peer_id, native_message['reply_message']['conversation_message_id']))
+        if lookups:
+            # ошибки тут не важны, обработчик события запросит ещё раз
+            await asyncio.gather(*lookups, return_exceptions=True)
+
+    async def _message_id_from_native(self, chat: Chat, native_message: dict):
+        message_data = await self._get_message_item(VK_CONVERSATION_ID + chat.id, native_message['conversation_message_id'])
+        return MessageID(chat, message_data['id'])
 
     def get_current_chat_from_native_message(self, message: VkDotDict):
-        return Chat(Platform.Vk, message.peer_id - VK_CONVERSATION_ID, None)
+        return self.get_current_chat(Platform.Vk, None, message.peer_id - VK_CONVERSATION_ID)
     
-    async def get_author(self, user_id: int):
-        author = self.coordinator.get_author(Platform.Vk, user_id)
-        if author:
-            return author
+    def _author_id_from_native(self, user_id: int) -> int:
+        return user_id
+
+    async def _fetch_users(self, user_ids: list[int]) -> dict[int, dict]:
+        response_data = await self._call(self.api.users.get, user_ids=','.join(map(str, user_ids)), fields=USER_FIELDS)
+        log.debug(f'Получили {len(response_data)} пользователей вк одним запросом')
+        return {user_data['id']: user_data for user_data in response_data}
+
+    def _author_from_user_data(self, user_data: dict) -> Author:
         pfp = None
-        response_data = self.api.users.get(user_ids=[user_id], fields=['photo_max_orig', 'screen_name'])
-        user_data = (response_data)[0]
         name = f'{user_data['first_name']} {user_data['last_name']}'
-        if user_data['photo_max_orig']:
+        if user_data.get('photo_max_orig'):
             pfp = UrlPicture(f'pfp of {name}', user_data['photo_max_orig'])
-        author = Author(Platform.Vk, id=user_id, 
-                        name=name, username=user_data['screen_name'], pfp=pfp)
-        self.coordinator.add_author(author)
-        return author
+        return Author(Platform.Vk, id=user_data['id'], 
+                      name=name, username=user_data.get('screen_name'), pfp=pfp)
+
+    async def _fetch_author(self, user_id: int) -> Author:
+        # запросы авторов за короткое окно уходят одним users.get
+        return self._author_from_user_data(await self.user_batcher.get(user_id))
+
+    async def _prefetch_authors(self, events: list):
+        """
+        Загружает всех новых авторов пачки событий одним запросом
+        """
+        user_ids = set()
+        for event in events:
+            if isinstance(event, VkBotMessageEvent) and event.message and event.message.get('from_id', 0) > 0:
+                if self.coordinator.get_author(Platform.Vk, event.message['from_id']) is None:
+                    user_ids.add(event.message['from_id'])
+        if user_ids:
+            await asyncio.gather(*(self.get_author(user_id) for user_id in user_ids), return_exceptions=True)
 
-    async def create_message_from_native(self, native_message: VkDotDict, chat: Chat, retrieve_from_db=True) -> Optional[Message]:
+    async def _prefetch_members(self):
+        """
+        Загружает авторов всех участников своих бесед при запуске
+        """
+        for chat in self.chats:
+            try:
+                response = await self._call(self.api.messages.get_conversation_members,
+                                            peer_id=VK_CONVERSATION_ID + chat.id, fields=USER_FIELDS)
+            except Exception as e:
+                log.warning(f'Не получилось получить участников беседы {chat}: {e}')
+                continue
+            for user_data in response.get('profiles', []):
+                self.coordinator.add_author(self._author_from_user_data(user_data))
+
+    async def create_message_from_native(self, native_message: VkDotDict, chat: Chat, retrieve_from_db=True, depth: int = 0) -> Optional[Message]:
         if native_message is None:
             return None
         
-        message_id = self._message_id_from_native(chat, native_message)
+        message_id = await self._message_id_from_native(chat, native_message)
         if retrieve_from_db:
             message = self.coordinator.db_get_message(message_id)
             if message:
                 return message
         reply_to = None
-        if 'reply_message' in native_message:
+        if 'reply_message' in native_message and self.can_resolve_reply(depth):
             try:
-                reply_data = self.api.messages.get_by_conversation_message_id(peer_id=VK_CONVERSATION_ID+chat.id, 
-                    conversation_message_ids=str(native_message['reply_message']['conversation_message_id']), extended=False)
-                reply_to = await self.create_message_from_native(reply_data['items'][0], chat)
+                reply_data = await self._get_message_item(VK_CONVERSATION_ID + chat.id,
+                    native_message['reply_message']['conversation_message_id'])
+                reply_to = await self.create_message_from_native(reply_data, chat, depth=depth + 1)
             except Exception:
                 log.warning('Не получилось получить reference сообщение')
         attachments = []
@@ -109,31 +254,51 @@ class VkBot(IBot):
     def is_running(self) -> bool:
         return self.task and self.task.done()
     
+    async def _handle_event(self, event):
+        log.debug(event)
+        if isinstance(event, VkBotMessageEvent):
+            if event.type == VkBotEventType.MESSAGE_NEW:
+                await self._handle_new_message(event.message)
+            elif event.type == VkBotEventType.MESSAGE_REPLY:
+                await self._handle_new_message(event.message)
+            elif event.type == VkBotEventType.MESSAGE_EDIT:
+                pass # TODO не поддерживается??
+
+    async def _handle_event_safe(self, event):
+        try:
+            await self._handle_event(event)
+        except Exception as e:
+            log.error(f'Обработка события вк выкинула исключение {e}')
+
     async def _run_polling(self):
-        while not asyncio.current_task().cancelled():
-            await asyncio.sleep(1)
+        backoff = 0
+        while True:
             try:
-                for event in self.longpoll.check():
-                    await asyncio.sleep(1)
-                    log.debug(event)
-                    if isinstance(event, VkBotMessageEvent):
-                        if event.type == VkBotEventType.MESSAGE_NEW:
-                            await self._handle_new_message(event.message)
-                        elif event.type == VkBotEventType.MESSAGE_REPLY:
-                            await self._handle_new_message(event.message)
-                        elif event.type == VkBotEventType.MESSAGE_EDIT:
-                            pass # TODO не поддерживается??
-                    if asyncio.current_task().cancelled():
-                        return
+                events = await asyncio.get_running_loop().run_in_executor(self.poll_executor, self.longpoll.check)
             except Exception as e:
-                log.error(e)
+                # ts не сдвинулся, так что после паузы эти же события придут снова
+                backoff = min(backoff * 2 or LONGPOLL_BACKOFF_START, LONGPOLL_BACKOFF_MAX)
+                log.error(f'Long poll вк упал с {e}, пробуем снова через {backoff} с')
+                await asyncio.sleep(backoff)
+                continue
+            backoff = 0
+            await asyncio.gather(self._prefetch_message_items(events), self._prefetch_authors(events))
+            # события разных бесед обрабатываются параллельно, порядок внутри беседы держит chat_sequencer
+            for event in events:
+                task = asyncio.create_task(self._handle_event_safe(event))
+                self.event_tasks.add(task)
+                task.add_done_callback(self.event_tasks.discard)
     
     def start(self):
+        if self.settings.get('prefetch_members', False):
+            asyncio.create_task(self._prefetch_members())
         self.task = asyncio.create_task(self._run_polling())
         log.info(f"Бот vk {self.display_name()} запущен")
 
     def stop(self):
         self.task.cancel()
+        self.executor.shutdown(wait=False)
+        self.poll_executor.shutdown(wait=False)
     
     def format_message(self, message: Message, include_reply = False) -> str:
         prefix = message.original_id.chat.prefix or Platform(message.original_id.chat.platform).name
@@ -159,43 +324,48 @@ class VkBot(IBot):
         links = ''
         text = self.format_message(message, reply_to==None)
 
-        photos: list[io.BytesIO] = []
-        files: list[io.BytesIO] = []
-        sticker: Optional[io.BytesIO] = None
+        photos: list[bytes] = []
+        files: list[tuple[str, memoryview]] = []
+        sticker: Optional[bytes] = None
         for attachment in message.attachments:
             if isinstance(attachment, IPicture):
-                image = attachment.get_image()
-                buffer = io.BytesIO()
-                image.save(buffer, format='webp')
-                buffer.seek(0)
-                photos.append(buffer)
+                image_data = await attachment.encode('webp')
+                if image_data is None:
+                    log.warning(f'Картинку {attachment.name} не получилось достать, пропускаем')
+                    continue
+                photos.append(image_data)
             elif isinstance(attachment, Sticker):
-                image = attachment.picture.get_image()
-                buffer = io.BytesIO()
-                image.resize((160, 160)).save(buffer, format='webp')
-                buffer.seek(0)
                 # TODO сделать обход невозможности отправить граффити
-                photos.append(buffer)
+                image_data = await attachment.picture.encode('webp', STICKER_SIZE)
+                if image_data is None:
+                    log.warning(f'Стикер {attachment.name} не получилось достать, пропускаем')
+                    continue
+                photos.append(image_data)
             elif isinstance(attachment, IFile):
-                file_data = attachment.get_file()
-                buffer = io.BytesIO(file_data)
-                buffer.seek(0)
-                buffer.name = attachment.name or 'file.dat'
-                files.append(buffer)
+                buffer = await attachment.fetch_buffer()
+                if buffer is None:
+                    log.warning(f'Файл {attachment.name} не скачался, отправляем вместо него ссылку')
+                    link = missing_file_link(attachment)
+                    links += f'{link.name}: {link.url} '
+                    continue
+                files.append((attachment.name or 'file.dat', buffer))
             elif isinstance(attachment, UrlLink):
                 links += f'{attachment.name}: {attachment.url} '
         
+        # картинки и документы загружаются одновременно, сообщение ждёт только самый долгий файл
+        uploaded_photos, uploaded_files = await asyncio.gather(
+            self.upload_message_pictures(photos),
+            self.upload_message_document(documents=files, peer_id=chat.id + VK_CONVERSATION_ID))
+
         if len(photos) >= 1:
-            uploaded = self.upload_message_pictures(photos)
-            log.info(f'picture: {uploaded}')
-            for photo in uploaded:
+            log.info(f'picture: {uploaded_photos}')
+            for photo in uploaded_photos:
                 photo_key = f'photo{photo["owner_id"]}_{photo["id"]}_{photo["access_key"]},'
                 attachment_str += photo_key
         
         if len(files) >= 1:
-            uploaded = self.upload_message_document(documents=files, peer_id=chat.id + VK_CONVERSATION_ID)
-            log.info(f'file: {uploaded}')
-            for doc_data in uploaded:
+            log.info(f'file: {uploaded_files}')
+            for doc_data in uploaded_files:
                 doc = doc_data['doc']
                 doc_key = f'doc{doc["owner_id"]}_{doc["id"]},'
                 attachment_str += doc_key
@@ -211,7 +381,8 @@ class VkBot(IBot):
         #     uploaded = self.upload.graffiti(sticker, chat.id + VK_CONVERSATION_ID, self.longpoll.group_id)
         #     log.info('file: ' + uploaded)
 
-        conversation_message_id = self.api.messages.send(
+        conversation_message_id = await self._call(
+            self.api.messages.send,
             chat_id=chat.id,
             message=text,
             attachment=attachment_str,
@@ -227,7 +398,8 @@ class VkBot(IBot):
         new_message.reply_to = old_message.reply_to
 
         text = self.format_message(new_message, reply==None)
-        self.api.messages.edit(
+        await self._call(
+            self.api.messages.edit,
             peer_id=message_id.chat.id + VK_CONVERSATION_ID,
             message=text,
             attachment=attachment_str,
@@ -236,44 +408,74 @@ class VkBot(IBot):
         )
 
     async def delete_message(self, message_id: MessageID):
-        self.api.messages.delete(
+        await self._call(
+            self.api.messages.delete,
             peer_id=message_id.chat.id + VK_CONVERSATION_ID,
             message_ids=str(message_id.id),
             delete_for_all=1
         )
     
-    def upload_message_pictures(self, pictures: list[io.BytesIO]):
-        url = self.api.photos.getMessagesUploadServer(group_id=self.longpoll.group_id)['upload_url']
+    def get_upload_semaphore(self) -> asyncio.Semaphore:
+        if self.upload_semaphore is None:
+            self.upload_semaphore = asyncio.Semaphore(self.settings.get('max_parallel_uploads', DEFAULT_MAX_PARALLEL_UPLOADS))
+        return self.upload_semaphore
 
-        with vk_api.upload.FilesOpener(pictures) as photo_files:
-            response = self.upload.http.post(url, files=photo_files)
+    async def _get_upload_url(self, kind: str, peer_id: int, fresh: bool = False) -> str:
+        key = (kind, peer_id)
+        cached = self.upload_servers.get(key)
+        if not fresh and cached and time.monotonic() - cached[1] < UPLOAD_SERVER_TTL:
+            return cached[0]
+        if kind == 'photo':
+            response = await self._call(self.api.photos.getMessagesUploadServer, group_id=self.longpoll.group_id)
+        else:
+            response = await self._call(self.api.docs.getMessagesUploadServer, group_id=self.longpoll.group_id,
+                                        peer_id=peer_id, type=kind)
+        self.upload_servers[key] = (response['upload_url'], time.monotonic())
+        return response['upload_url']
 
-        return self.api.photos.saveMessagesPhoto(**response.json())
-    
-    def upload_message_document(self, peer_id: int, documents: list[io.BytesIO], type: str = 'doc'):
-        values = {
-            'group_id': self.longpoll.group_id,
-            'peer_id': peer_id,
-            'type': type
-        }
-
-        method = self.api.docs.getMessagesUploadServer
-
-        url = method(**values)['upload_url']
+    async def _post_upload(self, kind: str, peer_id: int, field_name: str, data: bytes | memoryview, filename: str) -> dict:
+        """
+        Загружает файл на сервер загрузки VK. Если сохранённый адрес протух, запрашивает новый и пробует ещё раз
+        """
+        async with self.get_upload_semaphore():
+            for fresh in (False, True):
+                url = await self._get_upload_url(kind, peer_id, fresh)
+                form = aiohttp.FormData()
+                form.add_field(field_name, data, filename=filename)
+                try:
+                    async with http_client.get_session().post(url, data=form) as response:
+                        response.raise_for_status()
+                        result = await response.json(content_type=None)
+                except Exception as e:
+                    if fresh:
+                        raise
+                    log.warning(f'Загрузка на сервер вк не удалась ({e}), запрашиваем новый адрес')
+                    continue
+                if 'error' not in result:
+                    return result
+                if fresh:
+                    raise ValueError(f'Сервер загрузки вк вернул ошибку {result["error"]}')
+                log.warning(f'Сервер загрузки вк вернул ошибку {result["error"]}, запрашиваем новый адрес')
 
-        foobar = []
-        for doc in documents:
-            with vk_api.upload.FilesOpener(doc, 'file') as files:
-                response = self.vk_api.http.post(url, files=files).json()
+    async def _upload_picture(self, picture: bytes) -> list[dict]:
+        response = await self._post_upload('photo', 0, 'file0', picture, 'file0.jpg')
+        return await self._call(self.api.photos.saveMessagesPhoto, **response)
 
-            response.update({
-                'title': doc.name,
-                'tags': ''
-            })
+    async def upload_message_pictures(self, pictures: list[bytes]) -> list[dict]:
+        uploaded = await asyncio.gather(*(self._upload_picture(picture) for picture in pictures))
+        return [photo for photos in uploaded for photo in photos]
 
-            foobar.append(self.api.docs.save(**response))
-        
-        return foobar
+    async def _upload_document(self, peer_id: int, title: str, data: memoryview, type: str) -> dict:
+        extension = title.split('.')[-1]
+        response = await self._post_upload(type, peer_id, 'file', data, f'file0.{extension}')
+        response.update({
+            'title': title,
+            'tags': ''
+        })
+        return await self._call(self.api.docs.save, **response)
+    
+    async def upload_message_document(self, peer_id: int, documents: list[tuple[str, memoryview]], type: str = 'doc') -> list[dict]:
+        return list(await asyncio.gather(*(self._upload_document(peer_id, title, data, type) for title, data in documents)))
     
     def __hash__(self) -> int:
         return super().__hash__()
\ No newline at end of file
@@ -1,42 +1,81 @@
-from dataclasses import dataclass, field
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 from typing import Optional
+import asyncio
+import json
 import logging
 import typing
 
+import aiohttp
+
 from message_types import *
+from message_store import IMessageStore, SqliteMessageStore, DeadLetter, is_stored_attachment
+from message_cache import MessageCache
+from author_registry import AuthorRegistry
+from avatar_cache import AvatarCache
+from send_queue import *
+import http_client
+import image_worker
 
 log = logging.getLogger('main')
 
-MAX_FILE_SIZE=1024*1024*5
+# за сколько секунд редактирования одного сообщения склеиваются в одно
+DEFAULT_EDIT_DEBOUNCE = 1.0
+# сколько последних нативных сообщений каждого чата помнить, чтобы не запрашивать их для ответов
+DEFAULT_RECENT_MESSAGES_PER_CHAT = 200
+# насколько глубоко разворачивать цепочку ответов, дальше ответ на ответ не запрашивается
+DEFAULT_MAX_REPLY_DEPTH = 3
 
 @dataclass
 class Coordinator:
+    settings: dict[str, object] = field(default_factory=dict)
     bridges: list['Bridge'] = field(default_factory=list)
     bots: list['IBot'] = field(default_factory=list)
     chats: list['Chat'] = field(default_factory=list)
-    authors: list[Author] = field(default_factory=list)
+    authors: AuthorRegistry = field(default=None, init=False, repr=False)
+    avatars: AvatarCache = field(default=None, init=False, repr=False)
     
     chat_to_bot: dict[Chat, 'IBot'] = field(default_factory=dict)
+    # чат источник -> куда пересылать, пересобирается при изменении мостов и чатов
+    routes: dict[Chat, tuple[tuple['IBot', Chat], ...]] = field(default_factory=dict, repr=False)
+
+    message_cache: MessageCache = field(default=None, init=False, repr=False)
+    store: Optional[IMessageStore] = field(default=None, repr=False)
 
-    message_db: list[Message] = field(default_factory=list)
-    m_id_to_message: dict[MessageID, Message] = field(default_factory=dict)
+    def __post_init__(self):
+        self.authors = AuthorRegistry(refresh_ttl=self.settings.get('author_refresh_ttl', 60 * 60 * 6))
+        self.avatars = AvatarCache(self.settings.get('avatar_cache', None))
+        self.avatars.load()
+        self.message_cache = MessageCache(
+            max_entries=self.settings.get('cache_max_messages', 10000),
+            max_age=self.settings.get('cache_max_age', 60 * 60 * 24),
+            max_attachment_bytes=self.settings.get('cache_max_attachment_bytes', 256 * 1024 * 1024))
 
     def _save(self):
-        pass
+        log.info(f'Статистика кэша сообщений: {self.message_cache.stats()}')
+        log.info(f'Время кодирования картинок: {image_worker.encode_stats()}')
+        log.info(f'Статистика кэша аватарок: {self.avatars.stats()}')
+        for bot in self.bots:
+            if bot.send_queue:
+                log.info(f'Очередь отправки {bot.display_name()}: {bot.send_queue.stats()}')
+        if self.store:
+            self.store.flush()
 
-    def _load(self, db):
-        pass
+    def _load(self, db: str):
+        """
+        Подключает базу сообщений SQLite, чтобы ответы, редактирования и удаления работали после перезапуска
+        """
+        self.store = SqliteMessageStore(db, chat_resolver=self.get_chat, author_resolver=self.get_author,
+                                        batch_size=self.settings.get('database_batch_size', 100),
+                                        commit_interval=self.settings.get('database_commit_interval', 5.0))
 
     def add_author(self, author: Author):
-        if author not in self.authors:
-            self.authors.append(author)
+        if self.authors.get(author.platform, author.id) is None:
+            self.authors.add(author)
             log.info(f'Добавили автора {author.name}')
 
     def get_author(self, platform: Platform, id: int) -> Optional[Author]:
-        for author in self.authors:
-            if author.id == id and author.platform == platform:
-                return author
-        return None
+        return self.authors.get(platform, id)
     
     def start_all_bots(self):
         log.info('Запускаем всех ботов')
@@ -53,14 +92,14 @@ class Coordinator:
                 bot.stop()
             else:
                 log.info(f'Бот {bot.display_name()} уже остановлен')
+        self._save()
 
     def db_add_message(self, message: Message):
-        if message in self.message_db:
+        if message in self.message_cache:
             return
-        self.message_db.append(message)
-        for m_id in [message.original_id] + message.relay_ids:
-            if m_id not in self.m_id_to_message:
-                self.m_id_to_message[m_id] = message
+        self.message_cache.add(message)
+        if self.store:
+            self.store.add_message(message)
                 
         log.info(f'Добавили сообщение {message.original_id}')
         
@@ -71,11 +110,20 @@ class Coordinator:
             self.db_add_message(fwd)
     
     def db_get_message(self, message_id: MessageID) -> Optional[Message]:
-        return self.m_id_to_message.get(message_id)
+        message = self.message_cache.get(message_id)
+        if message is None and self.store:
+            message = self.store.get_message(message_id)
+            if message:
+                self.message_cache.add(message)
+        return message
 
     def db_add_message_relay_id(self, message_id: MessageID, message: Message):
-        self.m_id_to_message[message_id] = message
         message.relay_ids.append(message_id)
+        self.message_cache.add_id(message_id, message)
+        # после отправки вложения уже скачаны, их размер мог вырасти
+        self.message_cache.update_size(message)
+        if self.store:
+            self.store.add_relay_id(message_id, message)
         log.debug(f'Связали сообщение {message.author.name} {message.text[:20]}... с relay id {message_id}')
 
     def add_bridge(self, bridge: 'Bridge'):
@@ -90,6 +138,7 @@ class Coordinator:
         if chat not in self.chats:
             self.chats.append(chat)
         bridge.add_chat(chat)
+        self._compile_routes()
         log.info(f'Добавили чат {chat} в мост {bridge.id}')
     
     def link_bot_chat(self, bot: 'IBot', chat: Chat):
@@ -100,6 +149,7 @@ class Coordinator:
         bot.add_chat(chat)
         if chat not in self.chat_to_bot:
             self.chat_to_bot[chat] = bot
+        self._compile_routes()
         log.info(f'Связали {bot.display_name()} и чат {chat}')
     
     def add_bot(self, bot: 'IBot'):
@@ -107,55 +157,95 @@ class Coordinator:
             self.bots.append(bot)
             log.info(f'Добавили бота {bot.display_name()}')
 
+    def get_chat(self, chat: Chat) -> Chat:
+        """
+        Возвращает чат из конфига, равный переданному, чтобы у него был prefix
+        """
+        for known_chat in self.chats:
+            if known_chat == chat:
+                return known_chat
+        return chat
+
     def get_bridges(self) -> list['Bridge']:
         return self.bridges
     
     def get_bot_by_chat(self, chat: Chat) -> Optional['IBot']:
         return self.chat_to_bot.get(chat, None)
 
-    def find_relay_bots_chats(self, chat: Chat) -> dict['IBot', list[Chat]]:
-        chat_bridges = [b for b in self.get_bridges() if chat in b.chats]
-        total_chats = list()
-        for bridge in chat_bridges:
-            total_chats += bridge.chats
-        
-        # remove chat message came from
-        total_chats.remove(chat)
-
-        relay_chat_to_bot: dict['IBot', list[Chat]] = dict()
-        for relay_chat in total_chats:
-            bot = self.get_bot_by_chat(relay_chat)
-            if not isinstance(bot, IBot):
-                log.warning(f'Не могу найти бота по чату {relay_chat}')
-                continue
-            if bot not in relay_chat_to_bot:
-                relay_chat_to_bot[bot] = list()
-            relay_chat_to_bot[bot].append(relay_chat)
-        
-        return relay_chat_to_bot
+    def _compile_routes(self):
+        routes: dict[Chat, tuple[tuple['IBot', Chat], ...]] = dict()
+        for chat in self.chats:
+            targets: list[tuple['IBot', Chat]] = []
+            seen: set[Chat] = {chat}
+            for bridge in self.bridges:
+                if chat not in bridge.chats:
+                    continue
+                for relay_chat in bridge.chats:
+                    if relay_chat in seen:
+                        continue
+                    seen.add(relay_chat)
+                    bot = self.get_bot_by_chat(relay_chat)
+                    if bot is None:
+                        # чат ещё не слинкован с ботом, маршрут появится после link_bot_chat
+                        continue
+                    targets.append((bot, relay_chat))
+            routes[chat] = tuple(targets)
+        self.routes = routes
+
+    def get_relay_targets(self, chat: Chat) -> tuple[tuple['IBot', Chat], ...]:
+        """
+        Возвращает пары (бот, чат), в которые надо переслать сообщение из чата chat
+        """
+        targets = self.routes.get(chat)
+        if targets is None:
+            log.warning(f'Нет маршрутов для чата {chat}')
+            return tuple()
+        return targets
+
+    def is_parallel_send(self) -> bool:
+        return self.settings.get('parallel_send', True)
 
     async def send_all(self, message: Message):
         if message is None:
             log.error('Кто-то отправил None message')
             return
         log.debug(f'Отправляем сообщение [{message.original_id}] {message.author.name}: {message.text[:20]}...')
-        bots_chats = self.find_relay_bots_chats(message.original_id.chat)
-        for bot in bots_chats:
-            chats = bots_chats[bot]
-            for chat in chats:
-                m_id = None
-                try:
-                    m_id = await bot.send_message(chat, message)
-                except Exception as e:
-                    log.error(f'Отправка сообщения от бота {bot.display_name()} выкинула исключение {e}')
-                    continue
-                if m_id is None:
-                    log.error(f'send_message от бота {bot.display_name()} вернул None вместо messageid')
-                elif isinstance(m_id, list):
-                    for i in m_id:
-                        self.db_add_message_relay_id(i, message)
-                else:
-                    self.db_add_message_relay_id(m_id, message)
+        targets = self.get_relay_targets(message.original_id.chat)
+        # пока сообщение отправляется, кэш не должен выгрузить его вложения
+        self.message_cache.pin(message)
+        try:
+            if self.is_parallel_send():
+                # исключения ловятся в _send_to_chat, так что один упавший чат не отменяет остальные
+                await asyncio.gather(*(self._send_to_chat(bot, chat, message) for bot, chat in targets),
+                                     return_exceptions=True)
+            else:
+                for bot, chat in targets:
+                    await self._send_to_chat(bot, chat, message)
+        finally:
+            self.message_cache.unpin(message)
+
+    async def _send_to_chat(self, bot: 'IBot', chat: Chat, message: Message):
+        m_id = None
+        try:
+            m_id = await bot.queue_send(chat, message)
+        except PartialSendError as e:
+            # уже ушедшие части запоминаем, повтор из dead letters отправит только оставшиеся
+            log.error(f'Отправка сообщения от бота {bot.display_name()} оборвалась: {e}, причина {e.__cause__}')
+            for i in e.sent:
+                self.db_add_message_relay_id(i, message)
+            self._dead_letter(bot, e.__cause__, DeadLetter('send', bot.id, chat, message))
+            return
+        except Exception as e:
+            log.error(f'Отправка сообщения от бота {bot.display_name()} выкинула исключение {e}')
+            self._dead_letter(bot, e, DeadLetter('send', bot.id, chat, message))
+            return
+        if m_id is None:
+            log.error(f'send_message от бота {bot.display_name()} вернул None вместо messageid')
+        elif isinstance(m_id, list):
+            for i in m_id:
+                self.db_add_message_relay_id(i, message)
+        else:
+            self.db_add_message_relay_id(m_id, message)
     
     async def edit_all(self, new_message: Message):
         if new_message is None:
@@ -167,18 +257,40 @@ class Coordinator:
         if old_message is None:
             log.warning('Редактирование сообщения, которого нет в базе .-. чё делать')
             return
+        if old_message.text == new_message.text:
+            # discord присылает редактирование, например, когда подгрузилось превью ссылки
+            log.debug(f'Текст сообщения {new_message.original_id} не изменился, не редактируем')
+            return
+        edited = True
         for relay_m_id in old_message.relay_ids:
             bot = self.get_bot_by_chat(relay_m_id.chat)
             if not bot:
                 log.warning(f'Не могу найти бота по чату {new_message.original_id.chat}')
                 continue
-            
-            try:
-                await bot.edit_message(relay_m_id, new_message)
-            except Exception as e:
-                log.error(f'Редактирование сообщения от бота {bot.display_name()} выкинуло исключение {e}')
-                continue
-            
+            edited = await self._edit_in_chat(bot, relay_m_id, new_message) and edited
+        # запоминаем новый текст, чтобы следующее редактирование сравнивалось с ним. Если какая-то
+        # пересылка не отредактировалась, оставляем старый, иначе повтор из dead letters посчитают ненужным
+        if edited:
+            self._update_text(old_message, new_message.text)
+
+    def _update_text(self, message: Message, text: str):
+        message.text = text
+        if self.store:
+            self.store.update_text(message.original_id, text)
+
+    async def _edit_in_chat(self, bot: 'IBot', relay_m_id: MessageID, new_message: Message) -> bool:
+        try:
+            await bot.get_send_queue().run(relay_m_id.chat, lambda: bot.edit_message(relay_m_id, new_message))
+        except Exception as e:
+            log.error(f'Редактирование сообщения от бота {bot.display_name()} выкинуло исключение {e}')
+            self._dead_letter(bot, e, DeadLetter('edit', bot.id, relay_m_id.chat, new_message,
+                                                 relay_id=relay_m_id, text=new_message.text))
+            return False
+        # более старое редактирование, отложенное в dead letters, при повторе откатило бы текст назад
+        if self.store:
+            self.store.drop_dead_letters('edit', relay_m_id)
+        return True
+
     
     async def delete_all(self, message: Message):
         if message is None:
@@ -190,11 +302,65 @@ class Coordinator:
             if not bot:
                 log.warning(f'Не могу найти бота по чату {relay_m_id.chat}')
                 continue
-            try:
-                await bot.delete_message(relay_m_id)
-            except Exception as e:
-                log.error(f'Удаление сообщения от бота {bot.display_name()} выкинуло исключение {e}')
+            await self._delete_in_chat(bot, relay_m_id, message)
+
+    async def _delete_in_chat(self, bot: 'IBot', relay_m_id: MessageID, message: Message):
+        try:
+            await bot.get_send_queue().run(relay_m_id.chat, lambda: bot.delete_message(relay_m_id))
+        except Exception as e:
+            log.error(f'Удаление сообщения от бота {bot.display_name()} выкинуло исключение {e}')
+            self._dead_letter(bot, e, DeadLetter('delete', bot.id, relay_m_id.chat, message, relay_id=relay_m_id))
+
+    def _dead_letter(self, bot: 'IBot', exception: Exception, letter: DeadLetter):
+        """
+        Сохраняет операцию, которая не удалась из-за временной ошибки даже после повторов, чтобы повторить её при запуске
+        """
+        if not bot._is_transient(exception) and bot._retry_after(exception) is None:
+            return
+        bot.get_send_queue().dead_letters += 1
+        if self.store is None:
+            log.error(f'Без database операция {letter.operation} в чат {letter.chat} потеряна')
+            return
+        if letter.operation == 'send' and not all(map(is_stored_attachment, letter.message.attachments)):
+            # из базы сообщение вернётся без файлов и картинок, которые были только в памяти.
+            # Лучше честно потерять отправку, чем молча переслать её обрезанной
+            log.error(f'Сообщение {letter.message.original_id} с вложениями в памяти не отправлено в чат {letter.chat} и потеряно')
+            return
+        letter.error = repr(exception)
+        self.store.add_dead_letter(letter)
+        log.warning(f'Операция {letter.operation} в чат {letter.chat} отложена до следующего запуска')
+
+    def get_bot_by_id(self, bot_id: str) -> Optional['IBot']:
+        for bot in self.bots:
+            if bot.id == bot_id:
+                return bot
+        return None
+
+    async def replay_dead_letters(self):
+        """
+        Повторяет операции, которые не удались в прошлый раз. Ждёт, пока боты подключатся
+        """
+        if self.store is None:
+            return
+        await asyncio.sleep(self.settings.get('dead_letter_replay_delay', 10))
+        letters = self.store.pop_dead_letters()
+        if letters:
+            log.info(f'Повторяем {len(letters)} неудавшихся операций')
+        for letter in letters:
+            bot = self.get_bot_by_id(letter.bot_id)
+            if bot is None:
+                log.warning(f'Бота {letter.bot_id} больше нет, операция {letter.operation} пропущена')
                 continue
+            bot.get_send_queue().replayed += 1
+            match letter.operation:
+                case 'send':
+                    await self._send_to_chat(bot, letter.chat, letter.message)
+                case 'edit':
+                    if await self._edit_in_chat(bot, letter.relay_id, replace(letter.message, text=letter.text)):
+                        if message := self.db_get_message(letter.message.original_id):
+                            self._update_text(message, letter.text)
+                case 'delete':
+                    await self._delete_in_chat(bot, letter.relay_id, letter.message)
 
 
 @dataclass
@@ -218,6 +384,25 @@ class IBot:
     coordinator: Coordinator
     platform: Platform = field(default=None, init=False)
     chats: list[Chat] = field(default_factory=list)
+    settings: dict[str, object] = field(default_factory=dict)
+    # (platform, server_id, chat_id) -> чат, чтобы не перебирать chats на каждое событие
+    chat_index: dict[tuple[Platform, Optional[int], int], Chat] = field(default_factory=dict, init=False, repr=False)
+    send_queue: Optional[SendQueue] = field(default=None, init=False, repr=False)
+    # чат источник -> блокировка, по которой события одного чата обрабатываются по порядку
+    chat_sequencers: dict[Chat, asyncio.Lock] = field(default_factory=dict, init=False, repr=False)
+    # id сообщения -> последнее нативное редактирование и задача, которая перешлёт его после паузы
+    pending_edits: dict[MessageID, ...] = field(default_factory=dict, init=False, repr=False)
+    edit_timers: dict[MessageID, asyncio.Task] = field(default_factory=dict, init=False, repr=False)
+    # задачи пересылки редактирований до их завершения: из edit_timers задача убирается раньше,
+    # а event loop держит задачи только слабыми ссылками
+    edit_flushes: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
+    # чат -> id нативного сообщения -> нативное сообщение, от давних к недавним
+    recent_natives: dict[Chat, OrderedDict[int, ...]] = field(default_factory=dict, init=False, repr=False)
+
+    # лимиты платформы по умолчанию: сообщений в секунду на бота, в минуту на чат и сколько можно подряд в чат
+    DEFAULT_RATE_LIMIT: typing.ClassVar[Optional[float]] = None
+    DEFAULT_CHAT_RATE_LIMIT: typing.ClassVar[Optional[float]] = None
+    DEFAULT_CHAT_BURST: typing.ClassVar[int] = 1
 
     def _is_message_from_this_bot(self, native_message: ...) -> bool:
         """
@@ -231,7 +416,7 @@ class IBot:
         """
         ...
         
-    def _message_id_from_native(self, chat: Chat, native_message: ...):
+    async def _message_id_from_native(self, chat: Chat, native_message: ...) -> MessageID:
         ...
     
     def get_current_chat_from_native_message(self, native_message: ...) -> Optional[Chat]:
@@ -240,9 +425,10 @@ class IBot:
         """
         ...
     
-    async def create_message_from_native(self, native_message: ..., chat: Chat, retrieve_from_db: bool) -> Message:
+    async def create_message_from_native(self, native_message: ..., chat: Chat, retrieve_from_db: bool, depth: int = 0) -> Message:
         """
-        Создаёт обобщённое сообщение Message для пересылки из нативного для бота сообщения
+        Создаёт обобщённое сообщение Message для пересылки из нативного для бота сообщения.
+        depth - глубина в цепочке ответов, после max_reply_depth ответ не разворачивается
         """
         ...
     
@@ -282,14 +468,85 @@ class IBot:
         """
         ...
     
+    def _author_id_from_native(self, native_user: ...) -> int:
+        """
+        Возвращает id автора на платформе по нативному пользователю
+        """
+        ...
+
+    async def _fetch_author(self, native_user: ...) -> Author:
+        """
+        Получает актуальные данные автора: имя, ник, аватарку
+        """
+        ...
+
+    def _retry_after(self, exception: Exception) -> Optional[float]:
+        """
+        Если исключение значит, что упёрлись в лимит платформы, возвращает через сколько секунд повторить, иначе None
+        """
+        return None
+
+    def _is_transient(self, exception: Exception) -> bool:
+        """
+        Возвращает True для временных ошибок (сеть, таймаут, ошибка сервера), которые имеет смысл повторить
+        """
+        return isinstance(exception, (asyncio.TimeoutError, ConnectionError, aiohttp.ClientError, requests.RequestException))
+
+    async def get_author(self, native_user: ...) -> Author:
+        """
+        Возвращает автора из реестра координатора, загружая его при первой встрече и обновляя в фоне, если он устарел
+        """
+        registry = self.coordinator.authors
+        author = registry.get(self.platform, self._author_id_from_native(native_user))
+        if author is None:
+            author = await self._fetch_author(native_user)
+            self.coordinator.add_author(author)
+        elif registry.is_stale(author):
+            registry.refresh(author, lambda: self._fetch_author(native_user))
+        return author
+
     def get_current_chat(self, platform: Platform, server_id: Optional[int], chat_id: int) -> Optional[Chat]:
         """
         Возвращает чат из списка своих чатов, или None если сообщение не из интересующих чатов.
         """
-        for chat in self.chats:
-            if chat.platform == platform and chat.server_id == server_id and chat.id == chat_id:
-                return chat
-        return None
+        if len(self.chat_index) != len(self.chats):
+            self._reindex_chats()
+        return self.chat_index.get((platform, server_id, chat_id))
+
+    def _reindex_chats(self):
+        self.chat_index = {(chat.platform, chat.server_id, chat.id): chat for chat in self.chats}
+
+    def remember_native(self, chat: Chat, native_id: int, native_message: ...):
+        """
+        Запоминает нативное сообщение из потока событий, чтобы ответ на него не приходилось запрашивать
+        """
+        recent = self.recent_natives.get(chat)
+        if recent is None:
+            recent = self.recent_natives[chat] = OrderedDict()
+        recent[native_id] = native_message
+        recent.move_to_end(native_id)
+        while len(recent) > self.settings.get('recent_messages_per_chat', DEFAULT_RECENT_MESSAGES_PER_CHAT):
+            recent.popitem(last=False)
+
+    def get_recent_native(self, chat: Chat, native_id: int) -> Optional[...]:
+        recent = self.recent_natives.get(chat)
+        if recent is None:
+            return None
+        return recent.get(native_id)
+
+    def can_resolve_reply(self, depth: int) -> bool:
+        return depth < self.settings.get('max_reply_depth', DEFAULT_MAX_REPLY_DEPTH)
+
+    def chat_sequencer(self, chat: Chat) -> asyncio.Lock:
+        """
+        Новые сообщения, редактирования и удаления из одного чата обрабатываются строго по очереди,
+        а разные чаты - параллельно. asyncio.Lock отпускает ждущих в порядке прихода, поэтому
+        блокировку надо брать до первого await в обработчике
+        """
+        lock = self.chat_sequencers.get(chat)
+        if lock is None:
+            lock = self.chat_sequencers[chat] = asyncio.Lock()
+        return lock
 
     async def _handle_new_message(self, native_message: ...):
         if self._is_message_from_this_bot(native_message):
@@ -300,9 +557,10 @@ class IBot:
             log.debug(f'Сообщение не из моего чата: {self._message_preview_for_log(native_message)}')
             return
 
-        message = await self.create_message_from_native(native_message, chat, True)
-        self.coordinator.db_add_message(message)
-        await self.coordinator.send_all(message)
+        async with self.chat_sequencer(chat):
+            message = await self.create_message_from_native(native_message, chat, True)
+            self.coordinator.db_add_message(message)
+            await self.coordinator.send_all(message)
 
     async def _handle_edit_message(self, native_message: ...):
         if self._is_message_from_this_bot(native_message):
@@ -313,9 +571,41 @@ class IBot:
             log.debug(f'Сообщение не из моего чата: {self._message_preview_for_log(native_message)}')
             return
 
-        message = await self.create_message_from_native(native_message, chat, False)
-        # self.coordinator.db_add_message(message)
-        await self.coordinator.edit_all(message)
+        debounce = self.settings.get('edit_debounce', DEFAULT_EDIT_DEBOUNCE)
+        if not debounce:
+            await self._relay_edit(chat, native_message)
+            return
+        # _message_id_from_native может сходить в api, поэтому сначала берём блокировку чата,
+        # иначе редактирование могло бы записаться после удаления, пришедшего позже
+        async with self.chat_sequencer(chat):
+            message_id = await self._message_id_from_native(chat, native_message)
+            if message_id in self.pending_edits:
+                log.debug(f'Склеили редактирование сообщения {message_id} с предыдущим')
+            self.pending_edits[message_id] = native_message
+            if message_id not in self.edit_timers:
+                task = self.edit_timers[message_id] = asyncio.create_task(self._flush_edit(chat, message_id, debounce))
+                self.edit_flushes.add(task)
+                task.add_done_callback(self.edit_flushes.discard)
+
+    async def _flush_edit(self, chat: Chat, message_id: MessageID, delay: float):
+        """
+        Через delay секунд после первого редактирования пересылает только последнее
+        """
+        await asyncio.sleep(delay)
+        self.edit_timers.pop(message_id, None)
+        native_message = self.pending_edits.pop(message_id, None)
+        if native_message is None:
+            return
+        try:
+            await self._relay_edit(chat, native_message)
+        except Exception as e:
+            log.error(f'Пересылка редактирования выкинула исключение {e}')
+
+    async def _relay_edit(self, chat: Chat, native_message: ...):
+        async with self.chat_sequencer(chat):
+            message = await self.create_message_from_native(native_message, chat, False)
+            # self.coordinator.db_add_message(message)
+            await self.coordinator.edit_all(message)
 
     async def _handle_delete_message(self, native_message: ...):
         if self._is_message_from_this_bot(native_message):
@@ -326,17 +616,49 @@ class IBot:
             log.debug(f'Сообщение не из моего чата: {self._message_preview_for_log(native_message)}')
             return
         
-        message = self.coordinator.db_get_message(self._message_id_from_native(chat, native_message))
-        await self.coordinator.delete_all(message)
+        async with self.chat_sequencer(chat):
+            message_id = await self._message_id_from_native(chat, native_message)
+            # удалённое сообщение редактировать уже незачем
+            self.pending_edits.pop(message_id, None)
+            if timer := self.edit_timers.pop(message_id, None):
+                timer.cancel()
+            message = self.coordinator.db_get_message(message_id)
+            await self.coordinator.delete_all(message)
 
     def add_chat(self, chat: Chat):
         if chat not in self.chats:
             self.chats.append(chat)
+            self.chat_index[(chat.platform, chat.server_id, chat.id)] = chat
     
     def remove_chat(self, chat: Chat):
         if chat in self.chats:
             self.chats.remove(chat)
+            self.chat_index.pop((chat.platform, chat.server_id, chat.id), None)
     
+    def get_send_queue(self) -> SendQueue:
+        """
+        Исходящая очередь бота: порядок сообщений в чате, лимиты платформы и количество одновременных отправок
+        """
+        if self.send_queue is None:
+            chat_rate_limit = self.settings.get('chat_rate_limit', self.DEFAULT_CHAT_RATE_LIMIT)
+            self.send_queue = SendQueue(self._retry_after, self._is_transient,
+                                        rate=self.settings.get('rate_limit', self.DEFAULT_RATE_LIMIT),
+                                        chat_rate=chat_rate_limit / 60 if chat_rate_limit else None,
+                                        chat_burst=self.settings.get('chat_burst', self.DEFAULT_CHAT_BURST),
+                                        max_parallel=self.settings.get('max_parallel_sends', DEFAULT_MAX_PARALLEL_SENDS),
+                                        max_retries=self.settings.get('max_rate_limit_retries', DEFAULT_MAX_RATE_LIMIT_RETRIES),
+                                        retries=self.coordinator.settings.get('retries', DEFAULT_RETRIES),
+                                        retry_base_delay=self.coordinator.settings.get('retry_base_delay', DEFAULT_RETRY_BASE_DELAY),
+                                        retry_max_delay=self.coordinator.settings.get('retry_max_delay', DEFAULT_RETRY_MAX_DELAY))
+        return self.send_queue
+
+    async def queue_send(self, chat: Chat, message: Message) -> MessageID | list[MessageID]:
+        """
+        Отправляет сообщение через очередь отправки. Если платформа отправляет его одним запросом,
+        лимиты и повторы действуют на send_message целиком
+        """
+        return await self.get_send_queue().run(chat, lambda: self.send_message(chat, message))
+
     def display_name(self) -> str:
         """
         Имя текущего бота для логов
@@ -349,7 +671,7 @@ class IBot:
 @dataclass
 class IUploader:
     
-    def upload(self, data: bytes) -> str:
+    async def upload(self, data: bytes) -> Optional[str]:
         '''
         Можно выложить файл и получить строку
         '''
@@ -360,14 +682,14 @@ class IUploader:
 class ImgPushUploader(IUploader):
     upload_url: str
 
-    def upload(self, data: bytes | typing.BinaryIO) -> Optional[str]:
-        buf = None
+    async def upload(self, data: bytes | typing.BinaryIO) -> Optional[str]:
         if hasattr(data, 'read'):
-            buf = data
-        else:
-            buf = io.BytesIO(data)
-        answer = requests.post(self.upload_url, files={'file': ('pfp.png', buf)})
-        log.info(answer.text)
-        if answer.ok:
-            return self.upload_url + '/' + answer.json()['filename']
+            data = data.read()
+        form = aiohttp.FormData()
+        form.add_field('file', data, filename='pfp.png')
+        async with http_client.get_session().post(self.upload_url, data=form) as answer:
+            text = await answer.text()
+            log.info(text)
+            if answer.ok:
+                return self.upload_url + '/' + json.loads(text)['filename']
         return None
\ No newline at end of file